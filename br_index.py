@@ -0,0 +1,73 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`br_index.py` --- Index of border routers by neighbor ISD-AS
+==============================================================================
+"""
+
+
+class BRIndex(object):
+    """
+    Maps the neighbor ISD-AS of each interface to its border router and
+    interface ID. The index has to be told about every change of the
+    topology['BorderRouters'] dictionary it was built from.
+    """
+    def __init__(self, brs_dict):
+        """
+        :param dict brs_dict: the BorderRouters entry of a topology
+        """
+        # neighbor ISD-AS -> list of (border router name, interface id),
+        # the first entry is the one a scan over the topology would find
+        self.by_ia = {}
+        # border router name -> list of neighbor ISD-ASes of its interfaces
+        self.by_br = {}
+        for br_name, br_dict in brs_dict.items():
+            self.add(br_name, br_dict)
+
+    def lookup(self, ia):
+        """
+        :param str ia: ISD-AS string of the neighbor
+        :returns: (border router name, interface id), None if not connected
+        """
+        entries = self.by_ia.get(ia)
+        if not entries:
+            return None
+        return entries[0]
+
+    def add(self, br_name, br_dict):
+        """
+        Indexes the interfaces of a border router, replacing an older entry
+        with the same name
+        :param str br_name: name of the border router
+        :param dict br_dict: the border router entry of the topology
+        """
+        self.remove(br_name)
+        ias = []
+        for if_id, intf in br_dict['Interfaces'].items():
+            ia = intf['ISD_AS']
+            self.by_ia.setdefault(ia, []).append((br_name, if_id))
+            ias.append(ia)
+        self.by_br[br_name] = ias
+
+    def remove(self, br_name):
+        """
+        Removes a border router from the index
+        :param str br_name: name of the border router
+        """
+        for ia in self.by_br.pop(br_name, []):
+            entries = [entry for entry in self.by_ia[ia] if entry[0] != br_name]
+            if entries:
+                self.by_ia[ia] = entries
+            else:
+                del self.by_ia[ia]
@@ -0,0 +1,161 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`ccd_manager.py` --- OpenVPN client-configuration directory
+==============================================================================
+
+Keeps an index of the client configurations in the directory and applies
+batches of changes as a diff: only files whose content changes are written,
+each one atomically, so OpenVPN never reads a half written configuration.
+The manager expects to be the only writer of the directory while it lives.
+"""
+# Stdlib
+import logging
+import os
+import threading
+
+#: Keys of the counts returned by CCDManager.apply()
+CREATED = 'created'
+UPDATED = 'updated'
+REMOVED = 'removed'
+UNCHANGED = 'unchanged'
+INVALID = 'invalid'
+
+
+class CCDManager(object):
+    """
+    Diff-aware writer of an OpenVPN client-config directory
+    """
+    def __init__(self, path):
+        """
+        :param str path: the client-config directory
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # file name -> content, None until the file was read
+        self._index = None
+
+    def _load(self):
+        """
+        Lists the directory once, file contents are read when first needed
+        """
+        if self._index is not None:
+            return
+        self._index = {}
+        if not os.path.isdir(self.path):
+            return
+        for entry in os.scandir(self.path):
+            # hidden files are left over temporary files
+            if entry.is_file() and not entry.name.startswith('.'):
+                self._index[entry.name] = None
+
+    def _content(self, name):
+        content = self._index[name]
+        if content is None:
+            try:
+                with open(os.path.join(self.path, name)) as ccd_file:
+                    content = ccd_file.read()
+            except OSError:
+                content = ""
+            self._index[name] = content
+        return content
+
+    def get(self, name):
+        """
+        :returns: the configuration of a client, None if it has none
+        """
+        with self._lock:
+            self._load()
+            if name not in self._index:
+                return None
+            return self._content(name)
+
+    def configs(self):
+        """
+        :returns: dictionary of client name to configuration of all clients
+        """
+        with self._lock:
+            self._load()
+            return dict((name, self._content(name)) for name in list(self._index))
+
+    def replace_all(self, configs):
+        """
+        Makes the directory hold exactly the given configurations, see apply()
+        :param dict configs: client name to configuration
+        :returns: the counts of apply()
+        """
+        with self._lock:
+            self._load()
+            changes = dict.fromkeys(self._index)
+        changes.update(configs)
+        return self.apply(changes)
+
+    def apply(self, changes):
+        """
+        Writes the changed configurations and removes the dropped ones.
+        Changes of invalid client names (paths, hidden files) are skipped
+        and logged, nothing is written outside of the directory.
+        :param dict changes: client name to configuration, None removes it
+        :returns: dictionary of the counts of created, updated, removed,
+                  unchanged and invalid configurations
+        """
+        counts = {CREATED: 0, UPDATED: 0, REMOVED: 0, UNCHANGED: 0, INVALID: 0}
+        valid = {}
+        for name, content in changes.items():
+            if _valid_name(name):
+                valid[name] = content
+            else:
+                logging.warning("Skipping the configuration of invalid client name %r", name)
+                counts[INVALID] += 1
+        with self._lock:
+            self._load()
+            for name, content in valid.items():
+                if content is None:
+                    if name in self._index:
+                        self._remove(name)
+                        counts[REMOVED] += 1
+                    else:
+                        counts[UNCHANGED] += 1
+                elif name not in self._index:
+                    self._write(name, content)
+                    counts[CREATED] += 1
+                elif self._content(name) != content:
+                    self._write(name, content)
+                    counts[UPDATED] += 1
+                else:
+                    counts[UNCHANGED] += 1
+        return counts
+
+    def _write(self, name, content):
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, name)
+        tmp_path = os.path.join(self.path, ".%s.tmp" % name)
+        with open(tmp_path, 'w') as ccd_file:
+            ccd_file.write(content)
+        os.replace(tmp_path, path)
+        self._index[name] = content
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+        del self._index[name]
+
+
+def _valid_name(name):
+    """
+    :returns: True if name is a plain file name in the directory
+    """
+    return bool(name) and os.path.basename(name) == name and not name.startswith('.')
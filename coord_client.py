@@ -0,0 +1,149 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`coord_client.py` --- HTTP client for the SCION-coord
+==============================================================================
+
+Keeps the connections to the coordinator alive, compresses large request
+bodies, bounds every request in time and retries failed requests with
+jittered exponential backoff. A POST, e.g. the acknowledgment of the
+updates, is only sent again if it never reached the coordinator.
+"""
+# Stdlib
+import gzip
+import json
+import random
+import time
+
+# External
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+#: Seconds to establish a connection and to wait for data from the server
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+#: Seconds a request may take including all retries
+TOTAL_TIMEOUT = 120
+#: Retries after the first attempt
+RETRIES = 3
+#: Upper bound of the first and of all backoff delays in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+#: Request bodies of at least this many bytes are compressed
+COMPRESS_MIN_SIZE = 1024
+#: Connections kept open to the coordinator
+POOL_SIZE = 4
+#: Methods whose requests are retried even if the server may have got them
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+
+class CoordinatorError(requests.exceptions.RequestException):
+    """
+    Raised when the coordinator keeps answering with a server error
+    """
+    pass
+
+
+class CoordinatorClient(object):
+    """
+    Pooled and retrying HTTP client for the SCION-coord API
+    """
+    def __init__(self, compress_requests=False, pool_size=POOL_SIZE, retries=RETRIES,
+                 total_timeout=TOTAL_TIMEOUT):
+        """
+        :param bool compress_requests: gzip request bodies, the coordinator
+                                       has to accept Content-Encoding: gzip
+        :param int pool_size: connections kept open to the coordinator
+        :param int retries: retries after the first attempt
+        :param float total_timeout: seconds a request may take including retries
+        """
+        self.compress_requests = compress_requests
+        self.retries = retries
+        self.total_timeout = total_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip'
+
+    def get(self, url):
+        """
+        :returns: the response of a GET request
+        """
+        return self.request("GET", url)
+
+    def post(self, url, json_body):
+        """
+        :returns: the response of a POST request with a JSON body
+        """
+        data = json.dumps(json_body).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.compress_requests and len(data) >= COMPRESS_MIN_SIZE:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        return self.request("POST", url, data=data, headers=headers)
+
+    def request(self, method, url, data=None, headers=None, idempotent=None):
+        """
+        Sends a request, connection errors, timeouts and server errors are
+        retried until the retries or the total timeout are used up. Every
+        attempt only waits for the time left of the total timeout.
+        :param bool idempotent: the request may be sent again, by default
+                                only for GET and HEAD. Other requests are
+                                only retried if they were never sent.
+        :returns: the response, client errors (4xx) are not retried
+        :raises requests.exceptions.RequestException: if all attempts failed
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        deadline = time.monotonic() + self.total_timeout
+        attempt = 0
+        while True:
+            left = deadline - time.monotonic()
+            if attempt and left <= 0:
+                raise error
+            try:
+                resp = self.session.request(method, url, data=data, headers=headers,
+                                            timeout=(min(CONNECT_TIMEOUT, left),
+                                                     min(READ_TIMEOUT, left)))
+                if resp.status_code < 500 or not idempotent:
+                    return resp
+                resp.close()
+                error = CoordinatorError("%s %s: status code %s" %
+                                         (method, url, resp.status_code))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not idempotent and not _never_sent(e):
+                    raise
+                error = e
+            # exponential backoff with full jitter
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            if attempt > self.retries or time.monotonic() + delay >= deadline:
+                raise error
+            time.sleep(delay)
+
+
+def _never_sent(error):
+    """
+    :returns: True if a request failed before any of it was sent, i.e. the
+              connection could not be established
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or not error.args:
+        return False
+    # requests wraps the error of urllib3 in a MaxRetryError
+    reason = getattr(error.args[0], "reason", error.args[0])
+    return isinstance(reason, NewConnectionError)
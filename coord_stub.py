@@ -0,0 +1,156 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`coord_stub.py` --- Stand-in SCION-coord for the heartbeat fingerprints
+==============================================================================
+
+Answers the heartbeat API the way the SCION-coord has to for HB_DELTA:
+
+- a heartbeat with the full list of connections is answered with 200 and
+  the connections, and their fingerprint is remembered,
+- a heartbeat with only a fingerprint is answered with 304 if it matches
+  the remembered one and with 412 otherwise, the box then sends the full
+  list.
+
+Running this file starts the stand-in on a local port:
+    python3 coord_stub.py [port]
+and on a box, this runs a heartbeat exchange of every case against it:
+    python3 coord_stub.py --check
+"""
+# Stdlib
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# SCION-Box
+from defines import ACTIVE
+
+#: Default port of the stand-in
+STUB_PORT = 8080
+
+
+class StubCoordinator(HTTPServer):
+    """
+    HTTP server keeping the fingerprint of every ISD-AS it heard of
+    """
+    def __init__(self, port=STUB_PORT):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _HeartbeatHandler)
+        self.lock = threading.Lock()
+        #: "ISD-AS" -> fingerprint of the last full heartbeat
+        self.fingerprints = {}
+        #: the answered status codes, in order
+        self.answers = []
+
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_port
+
+    def forget(self):
+        """
+        Drops the remembered fingerprints, as after a change on the coordinator
+        """
+        with self.lock:
+            self.fingerprints.clear()
+
+
+class _HeartbeatHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if not self.path.startswith("/api/as/heartbeat/"):
+            self._answer(404)
+            return
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        ia_list = query["IAList"]
+        with self.server.lock:
+            if all('Connections' in ia for ia in ia_list):
+                for ia in ia_list:
+                    self.server.fingerprints[_ia_key(ia)] = ia["Fingerprint"]
+                reply = {'IAList': [_reply_ia(ia) for ia in ia_list]}
+                self._answer(200, json.dumps(reply).encode())
+            elif all(self.server.fingerprints.get(_ia_key(ia)) == ia["Fingerprint"]
+                     for ia in ia_list):
+                self._answer(304)
+            else:
+                self._answer(412)
+
+    def _answer(self, status, body=b""):
+        self.server.answers.append(status)
+        self.send_response(status)
+        if status != 304:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _ia_key(ia):
+    return "%s-%s" % (ia["ISD"], ia["AS"])
+
+
+def _reply_ia(ia):
+    """
+    Echoes the connections of an ISD-AS as unchanged
+    """
+    connections = []
+    for br in ia["Connections"]:
+        isd, as_ = br["NeighborIA"].split("-")
+        connections.append({'NeighborISD': isd, 'NeighborAS': as_,
+                            'NeighborIP': br["NeighborIP"], 'RemotePort': br["RemotePort"],
+                            'Status': ACTIVE})
+    return {'ISD': ia["ISD"], 'AS': ia["AS"], 'Connections': connections}
+
+
+def check():
+    """
+    Runs the heartbeat requests of this box against a stand-in, covering the
+    full reply, the unchanged (304) and the precondition failed (412) case
+    :return: True if all answers were as expected
+    """
+    # imported here, the stand-in itself runs without SCION
+    import heartbeat
+    import utils
+    stub = StubCoordinator(0)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    heartbeat.SCION_COORD_URL = stub.url()
+    ia_list = utils._get_my_asid()
+    ok = True
+    for name, full, forget, expected in (
+            ("unknown fingerprint", False, False, [412, 200]),
+            ("unchanged", False, False, [304]),
+            ("full list", True, False, [200]),
+            ("changed on the coordinator", False, True, [412, 200])):
+        if forget:
+            stub.forget()
+        del stub.answers[:]
+        resp, err = heartbeat.request_server(ia_list, full=full)
+        if resp is not None:
+            resp.close()
+        passed = err is None and stub.answers == expected
+        ok = ok and passed
+        print("%s %s: answers %s, expected %s" %
+              ("[OK]" if passed else "[FAILED]", name, stub.answers, expected))
+    stub.shutdown()
+    return ok
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--check":
+        sys.exit(0 if check() else 1)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else STUB_PORT
+    StubCoordinator(port).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -21,11 +21,20 @@ This file is located in $SCIONBOXPATH/
 #StdLib
 import os
 
+#SCION-Box
+from metrics import DEFAULT_METRICS_DIR
+
 #: URL of SCION Coordination Service
 SCION_COORD_URL = "https://coord.scionproto.net/"
 INIT_URL = SCION_COORD_URL + "api/as/initBox"
 CONNECT_URL = SCION_COORD_URL + "api/as/connectBox/"
 HB_URL = SCION_COORD_URL + "api/as/heartbeat/"
+#: Seconds between two heartbeats
+HEARTBEAT_INTERVAL = 60
+#: Send only a fingerprint of the border routers in the heartbeat, the full
+#: list is sent when the SCION-coord asks for it. Needs coordinator support,
+#: coord_stub.py shows the expected answers.
+HB_DELTA = False
 #: Cerfificate Version
 INITIAL_CERT_VERSION = 0
 INITIAL_TRC_VERSION = 0
@@ -62,14 +71,59 @@ CONN_TESTER_INPUT_PATH = os.path.join(SCION_BOX_PATH, "conf/config.json")
 CONN_TESTER_PORTS = 100
 CONN_TESTER_START_PORT = 50000
 CONN_TESTER_HOST = "https://coord.scionproto.net:1025/udp-test"
+#: Host of the UDP reflector used to scan the ports in-process, the
+#: connection-tester is used if empty
+UDP_REFLECTOR = ""
+UDP_REFLECTOR_PORT = 10243
+#: Ports probed at the same time and seconds to wait for each reflection
+PORT_SCAN_PARALLELISM = 32
+PORT_SCAN_TIMEOUT = 1
+#: Distance of the ports sampled first by the adaptive scan
+PORT_SCAN_STRIDE = 8
+#: Highest number of ports above CONN_TESTER_START_PORT the adaptive scan probes
+PORT_SCAN_MAX_PORTS = 1000
+#: Most probes the adaptive scan sends, the budget of the connection-tester
+PORT_SCAN_MAX_PROBES = CONN_TESTER_PORTS
 #: Constants needed for RTT Test
 RTT_SERVER_PORT = 10241
 MEASUREMENTS = 20
+#: Seconds an RTT session may stay silent before the server drops it
+RTT_SESSION_TIMEOUT = 30
+#: Pending connections the RTT server accepts before refusing new ones
+RTT_SERVER_BACKLOG = 512
+#: Address the UDP probe echo of the RTT server is bound to, the address of
+#: INTERFACE (the tunnel to the neighbors) if empty
+RTT_ECHO_ADDR = ""
+#: RTT probe mode: "udp" pipelines probes, "tcp" uses the ping-pong session
+RTT_PROBE_MODE = "udp"
+#: Seconds between two UDP probes
+RTT_PROBE_INTERVAL = 0.01
+#: Seconds to wait for replies after the last UDP probe was sent
+RTT_PROBE_TIMEOUT = 1
 #: Constants needed for BW Test
 PTR_SERVER_PORT = 10242
 PTR_PATH_CLIENT = "./igi-ptr-2.1/ptr-client"
-OUTPUT_PATH_CLIENT = ""
 REPETITIONS = 5
+# "native" probes in-process with ptr_test, "ptr-client" runs PTR_PATH_CLIENT
+BW_TEST_ENGINE = "native"
+#: Constants needed for the link test scheduler
+# number of neighbors measured at the same time
+LINK_TEST_WORKERS = 8
+# seconds a single neighbor may take for its BW and RTT test
+LINK_TEST_NEIGHBOR_BUDGET = 60
+# seconds the whole link test may take, unfinished neighbors report -1
+LINK_TEST_BUDGET = 300
+# seconds the workers get after the budget to end the operation in progress
+LINK_TEST_GRACE = 2
+#: Cache of link test results, reused by later runs for the same neighbor IP
+LINK_CACHE_FILE = "link_cache.json"
+# seconds a measurement stays valid
+LINK_CACHE_TTL = 900
+# maximal number of cached neighbors, the oldest entries are evicted first
+LINK_CACHE_SIZE = 512
+#: Directory of the node exporter textfile collector the phase timings are
+#: written to, nothing is written if it does not exist, empty disables them
+METRICS_DIR = DEFAULT_METRICS_DIR
 #: Logging
 BOX_LOGFILE = "Box.log"
 LINK_TEST_LOGFILE = "linkTest.log"
@@ -0,0 +1,272 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`gen_swap.py` --- Staged writing and atomic switch of the gen folder
+==============================================================================
+"""
+# Stdlib
+import errno
+import fcntl
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+#: Build new gen trees next to the live one and switch atomically
+GEN_STAGED = True
+#: Number of replaced gen trees kept as snapshots for rollbacks
+GEN_SNAPSHOTS = 3
+
+
+@contextmanager
+def gen_lock(gen_path):
+    """
+    Holds an exclusive lock next to the gen folder while the with block
+    runs, a concurrent run that stages a gen tree waits for it. Staging a
+    tree up to its commit or abort has to happen under the lock.
+    :param str gen_path: path of the gen folder (or symlink)
+    """
+    parent, name = os.path.split(os.path.abspath(gen_path))
+    os.makedirs(parent, exist_ok=True)
+    with open(os.path.join(parent, ".%s.lock" % name), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def staging_path(gen_path):
+    """
+    Removes the staged trees left over by interrupted runs, see
+    remove_stale_staging()
+    :param str gen_path: path of the gen folder (or symlink)
+    :returns: an unused hidden sibling path for a new gen tree
+    """
+    remove_stale_staging(gen_path)
+    return _sibling_path(gen_path, "")
+
+
+def remove_stale_staging(gen_path):
+    """
+    Removes all staged trees next to the gen folder except the live one. A
+    run that crashed or was killed before it switched in or aborted its
+    staged tree leaves it behind. The caller has to hold gen_lock(), else
+    the staged tree of a concurrent run would be removed as well.
+    :param str gen_path: path of the gen folder (or symlink)
+    """
+    parent, name = os.path.split(os.path.abspath(gen_path))
+    prefix = ".%s." % name
+    live = os.path.realpath(gen_path)
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if (entry.startswith(prefix) and entry[len(prefix):].isdigit() and
+                os.path.realpath(path) != live):
+            shutil.rmtree(path, True)
+
+
+def snapshot_path(gen_path):
+    """
+    :param str gen_path: path of the gen folder (or symlink)
+    :returns: an unused hidden sibling path for a snapshot
+    """
+    return _sibling_path(gen_path, "snap.")
+
+
+def _sibling_path(gen_path, kind):
+    parent, name = os.path.split(os.path.abspath(gen_path))
+    while True:
+        path = os.path.join(parent, ".%s.%s%d" % (name, kind, time.time() * 1e9))
+        if not os.path.lexists(path):
+            return path
+
+
+def clone_tree(gen_path, staged_path):
+    """
+    Creates a staged tree that shares all files of the live gen folder
+    through hard links
+    :param str gen_path: path of the live gen folder
+    :param str staged_path: path returned by staging_path()
+    """
+    if os.path.isdir(gen_path):
+        shutil.copytree(gen_path, staged_path, symlinks=True, copy_function=os.link)
+    else:
+        os.makedirs(staged_path)
+
+
+def break_links(path, recursive=True):
+    """
+    Gives the files below path their own inode, so that writers that modify
+    files in place do not change the live gen folder through a hard link
+    :param str path: directory in a staged tree
+    :param bool recursive: also handle the files of the sub directories
+    """
+    if not os.path.isdir(path):
+        return
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if os.path.islink(file_path) or os.stat(file_path).st_nlink < 2:
+                continue
+            tmp_path = file_path + ".tmp"
+            shutil.copy2(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+        if not recursive:
+            break
+
+
+def _fsync_tree(path):
+    """
+    Flushes all files and directories below path to disk
+    """
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if os.path.islink(file_path):
+                continue
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        _fsync_dir(root)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _switch(gen_path, path):
+    """
+    Atomically points the gen symlink to path
+    :returns: path of the tree that was live before, None if there was none
+    :raises FileNotFoundError: if path is not a directory
+    """
+    if not os.path.isdir(path):
+        # never leave the gen symlink dangling
+        raise OSError(errno.ENOENT, "No gen tree to switch to", path)
+    parent, name = os.path.split(os.path.abspath(gen_path))
+    old_path = None
+    if os.path.islink(gen_path):
+        old_path = os.path.join(parent, os.readlink(gen_path))
+    elif os.path.isdir(gen_path):
+        # first switch, move the directory aside for the symlink
+        old_path = _sibling_path(gen_path, "")
+        os.rename(gen_path, old_path)
+    link_path = os.path.join(parent, ".%s.link" % name)
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(path), link_path)
+    os.replace(link_path, gen_path)
+    _fsync_dir(parent)
+    if old_path is not None and os.path.abspath(old_path) == os.path.abspath(path):
+        return None
+    return old_path
+
+
+def commit_staging(gen_path, staged_path, keep=GEN_SNAPSHOTS):
+    """
+    Syncs the staged tree and switches the gen symlink to it, the previous
+    tree is kept as a snapshot
+    :param str gen_path: path of the live gen folder (or symlink)
+    :param str staged_path: the complete new gen tree
+    :param int keep: number of snapshots to keep, 0 removes the previous tree
+    :raises FileNotFoundError: if the staged tree does not exist
+    """
+    if not os.path.isdir(staged_path):
+        raise OSError(errno.ENOENT, "Staged gen tree is missing", staged_path)
+    _fsync_tree(staged_path)
+    old_path = _switch(gen_path, staged_path)
+    if old_path is None:
+        return
+    if keep > 0:
+        os.rename(old_path, snapshot_path(gen_path))
+    else:
+        shutil.rmtree(old_path, True)
+    prune_snapshots(gen_path, keep)
+
+
+def abort_staging(staged_path):
+    """
+    Removes a staged tree that will not be switched in
+    """
+    shutil.rmtree(staged_path, True)
+
+
+def list_snapshots(gen_path):
+    """
+    :param str gen_path: path of the gen folder (or symlink)
+    :returns: paths of the snapshots, the newest first
+    """
+    parent, name = os.path.split(os.path.abspath(gen_path))
+    prefix = ".%s.snap." % name
+    live = os.path.realpath(gen_path)
+    snapshots = []
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if (entry.startswith(prefix) and entry[len(prefix):].isdigit() and
+                os.path.realpath(path) != live):
+            snapshots.append((int(entry[len(prefix):]), path))
+    return [path for _, path in sorted(snapshots, reverse=True)]
+
+
+def prune_snapshots(gen_path, keep=GEN_SNAPSHOTS):
+    """
+    Removes all but the newest keep snapshots
+    """
+    for path in list_snapshots(gen_path)[keep:]:
+        shutil.rmtree(path, True)
+
+
+def take_snapshot(gen_path, keep=GEN_SNAPSHOTS):
+    """
+    Keeps a copy of the live gen folder before it is changed in place, see
+    clone_tree()
+    :param str gen_path: path of the live gen folder (or symlink)
+    :param int keep: number of snapshots to keep
+    :returns: path of the snapshot, None if there is no gen folder or keep is 0
+    """
+    if keep <= 0 or not os.path.isdir(gen_path):
+        return None
+    path = snapshot_path(gen_path)
+    clone_tree(gen_path, path)
+    prune_snapshots(gen_path, keep)
+    return path
+
+
+def restore_snapshot(gen_path, snapshot=None, keep=GEN_SNAPSHOTS):
+    """
+    Switches the gen symlink back to a snapshot. The tree that was live
+    becomes the newest snapshot, so restoring the newest snapshot again
+    rolls forward.
+    :param str gen_path: path of the live gen folder (or symlink)
+    :param str snapshot: path of the snapshot, the newest one if None
+    :param int keep: number of snapshots to keep
+    :returns: path of the restored snapshot, None if there is none
+    """
+    if snapshot is None:
+        snapshots = list_snapshots(gen_path)
+        if not snapshots:
+            return None
+        snapshot = snapshots[0]
+    old_path = _switch(gen_path, snapshot)
+    if old_path is not None:
+        os.rename(old_path, snapshot_path(gen_path))
+        # the restored snapshot is live now, it does not count
+        prune_snapshots(gen_path, max(keep, 1))
+    return snapshot
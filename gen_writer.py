@@ -0,0 +1,78 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`gen_writer.py` --- Parallel writing of gen folder instances
+==============================================================================
+"""
+# Stdlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from shutil import rmtree
+
+#: Number of threads writing instance directories, 1 writes sequentially
+GEN_WORKERS = 8
+
+
+def serialize_topology(write_topology_file, tp, type_key):
+    """
+    Serializes the topology file of one service type once, so the result can
+    be copied to all instances of the type
+    :param write_topology_file: the local_config_util function of the caller
+    :param dict tp: the topology
+    :param str type_key: topology key of the service type
+    :returns: dictionary of file name to content of the written files
+    """
+    tmp_path = tempfile.mkdtemp()
+    try:
+        write_topology_file(tp, type_key, tmp_path)
+        files = {}
+        for name in os.listdir(tmp_path):
+            with open(os.path.join(tmp_path, name), 'rb') as topo_file:
+                files[name] = topo_file.read()
+        return files
+    finally:
+        rmtree(tmp_path, True)
+
+
+def write_topology(files, instance_path):
+    """
+    Writes the serialized topology files to an instance directory
+    :param dict files: as returned by serialize_topology
+    :param str instance_path: directory of the instance
+    """
+    os.makedirs(instance_path, exist_ok=True)
+    for name, data in files.items():
+        path = os.path.join(instance_path, name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as topo_file:
+            topo_file.write(data)
+        os.replace(tmp_path, path)
+
+
+def run_tasks(tasks, workers=GEN_WORKERS):
+    """
+    Runs the tasks on a bounded thread pool
+    :param tasks: list of functions without arguments
+    :param int workers: number of threads, 1 runs the tasks in order
+    :raises: the exception of the first failed task
+    """
+    if workers <= 1:
+        for task in tasks:
+            task()
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        for future in futures:
+            future.result()
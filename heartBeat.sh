@@ -3,9 +3,11 @@
 
 export PYTHONPATH=$PYTHONPATH:../scion/python/:../scion-web/:../scion/:
 
+# The daemon sends a heartbeat every HEARTBEAT_INTERVAL seconds (defines.py,
+# or --interval), restart it if it dies
 while :
 do
-  python3 heartbeat.py
+  python3 heartbeat.py --daemon
   sleep 60
 done
 
@@ -18,6 +18,8 @@
 This file is located in $SCIONPATH/python/topology/
 """
 # Stdlib
+import argparse
+import copy
 import json
 import requests
 import netifaces as ni
@@ -28,15 +30,21 @@ import time
 from lib.packet.scion_addr import ISD_AS
 
 # SCION-Box
+import metrics
 import utils
+from br_index import BRIndex
+from topo_diff import diff_topology
 from defines import(
     SCION_COORD_URL,
+    HEARTBEAT_INTERVAL,
+    HB_DELTA,
     CREATE,
     UPDATE,
     REMOVE,
     BOX_LOGFILE,
     FORMAT,
     INTERFACE,
+    METRICS_DIR,
     PARENT,
     CHILD,
     CORE
@@ -45,67 +53,101 @@ from defines import(
 
 logging.basicConfig(filename=BOX_LOGFILE,level=logging.DEBUG, format=FORMAT)
 
+#: HTTP session reused by all heartbeats of a daemon, keeps the TLS connection alive
+_session = None
+
+
+def _get_session():
+    """
+    Returns the HTTP session used to talk to the SCION-coord
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
 
 def heartbeat():
     """
     The main function that updates the topology configurations
     """
-    is_modified = False
     ia_list = utils._get_my_asid()
-    resp, err = request_server(ia_list)
+    with metrics.timer("coord_request", api="heartbeat"):
+        resp, err = request_server(ia_list)
     if err:
         logging.error("Failed to connect to SCION-COORD server: \n%s" % err)
         exit(1)
+    # the streamed response holds a pooled connection until it is closed
+    with resp:
+        _handle_response(resp)
+
+
+def _handle_response(resp):
+    """
+    Applies the answer of the SCION-coord to the heartbeat
+    :param resp: response of request_server()
+    """
+    if resp.status_code == 304:
+        # the coordinator has the same border routers as we do
+        logging.info("Nothing changed not Restarting SCION")
     elif resp.headers['content-type'] == 'application/json; charset=utf-8':
         resp_dict = json.loads(resp.content.decode('utf8').replace("'", '"'))
         ia_list = resp_dict["IAList"]
-        new_br_list = []
+        logging.info("Received answer from Heartbeat function : \n%s" % resp_dict)
         for ia in ia_list:
             connection_dict = ia["Connections"]
             _isd = ia["ISD"]
             _as = ia["AS"]
             ia = ISD_AS.from_values(_isd, _as)
-            as_obj, original_topo = utils.load_topology(ia)
+            with metrics.timer("topology_load"):
+                as_obj, original_topo = utils.load_topology(ia)
             topo = original_topo
-            logging.info("Received answer from Heartbeat function : \n%s" % resp_dict)
+            old_topo = copy.deepcopy(original_topo)
+            index = BRIndex(topo['BorderRouters'])
             # check for new neighbors
             for connection in connection_dict:
                 if connection["Status"] == CREATE:
-                    is_modified = True
-                    topo = utils._add_br(connection, topo)
-                    new_br_list.append(utils._get_br_id(connection,topo)[0])
+                    topo = utils._add_br(connection, topo, index)
                 elif connection["Status"] == UPDATE:
-                    is_modified = True
-                    topo = utils._update_br(connection, topo)
+                    topo = utils._update_br(connection, topo, index)
                 elif connection["Status"] == REMOVE:
-                    is_modified = True
-                    topo = utils._remove_br(connection, topo)
-
-        if not is_modified:
-            # no change
-            logging.info("Nothing changed not Restarting SCION")
-        else:
-            utils.generate_local_gen(ia, as_obj, topo)
-            logging.info("[INFO] Restarting SCION")
-            utils.restart_scion()
+                    topo = utils._remove_br(connection, topo, index)
+            # repeated or redundant requests can leave the topology as it was
+            diff = diff_topology(old_topo, topo)
+            if diff.is_empty():
+                logging.info("Nothing changed in %s not Restarting SCION" % ia)
+                continue
+            logging.info("Topology of %s changed: %s" % (ia, diff))
+            with metrics.timer("gen_generate"):
+                utils.generate_local_gen(ia, as_obj, topo, old_topo)
+            logging.info("[INFO] Reloading SCION")
+            with metrics.timer("scion_reload"):
+                utils.reload_scion(ia, old_topo, topo)
     # In case we receive the gen folder from the coordinator
     elif resp.headers['content-type'] == 'application/gzip':
         logging.info("[INFO] Received gen folder ")
-        utils.parse_response(resp)
+        with metrics.timer("gen_extract"):
+            utils.parse_response(resp)
         logging.info("[INFO] Starting SCION !")
-        utils.restart_scion()
+        with metrics.timer("scion_restart"):
+            utils.restart_scion()
     else:
         # Received something else
         # TODO UPDATE BOX ?
         pass
 
 
-def request_server(ia_list):
+def request_server(ia_list, full=not HB_DELTA):
     """
     Communicate with SCION coordination server over HTTPS.
     Call the Heartbeat API
     Send Post Request to the SCION coord,
     receive the list of current neighbor
+    :param ia_list: ISD-ASes running on this machine
+    :param full: send the full list of connections and not only its fingerprint
     :returns dict current_neighbors:
     """
     credentials = utils.get_credentials()
@@ -114,25 +156,72 @@ def request_server(ia_list):
     IAList = []
     for ia in ia_list:
         list = utils.assemble_current_br_list(ia)
-        IA = {'ISD': ia._isd, 'AS': ia._as, 'Connections': list}
+        IA = {'ISD': ia._isd, 'AS': ia._as, 'Fingerprint': utils.topology_fingerprint(list)}
+        if full:
+            IA['Connections'] = list
         IAList.append(IA)
     ip_address = ni.ifaddresses(INTERFACE)[ni.AF_INET][0]['addr']
     # Send the list of current connections aswell as, userMail, IA of the scionLabAS and the ip address.
     HeartBeatQuery = {'IAList': IAList, 'UserMail' : credentials["UserMail"], 'IP': ip_address, 'Time': time.time()}
     logging.info("Calling HB API at: %s, with json: %s", POST_REQ, HeartBeatQuery)
     try:
-        resp = requests.post(POST_REQ, json=HeartBeatQuery, timeout=10)
+        # a gen folder in the answer is extracted while it is downloaded
+        resp = _get_session().post(POST_REQ, json=HeartBeatQuery, timeout=10, stream=True)
     except requests.exceptions.RequestException as e:
         return None, e
-    if resp.status_code == 200:
+    if resp.status_code in (200, 304):
         return resp, None
+    resp.close()
+    if resp.status_code == 412 and not full:
+        # fingerprints differ, the coordinator needs the full list
+        logging.info("Fingerprint mismatch, sending all connections")
+        return request_server(ia_list, full=True)
     else:
         logging.error("[ERROR] Wrong Status Code ! %s", resp.status_code)
         exit(1)
 
 
+def run_daemon(interval=HEARTBEAT_INTERVAL):
+    """
+    Runs heartbeat() every `interval` seconds in this process, so the imports,
+    the coordinator connection and the cached state survive between beats
+    :param interval: seconds between the start of two heartbeats
+    """
+    logging.info("Starting heartbeat daemon, interval %ss", interval)
+    next_beat = time.monotonic()
+    while True:
+        try:
+            with metrics.timer("total"):
+                heartbeat()
+        except SystemExit as e:
+            # heartbeat() exits on errors, which must not end the daemon
+            logging.error("Heartbeat failed with exit code %s", e.code)
+        except Exception:
+            logging.exception("Heartbeat failed")
+        metrics.write_textfile(METRICS_DIR, "heartbeat")
+        next_beat += interval
+        now = time.monotonic()
+        if next_beat < now:
+            # skip the beats missed while this one was running
+            next_beat = now + interval - (now - next_beat) % interval
+        time.sleep(next_beat - now)
+
+
 def main():
-    heartbeat()
+    parser = argparse.ArgumentParser(description="Heartbeat to the SCION-coord")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and send a heartbeat every interval")
+    parser.add_argument("--interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds between two heartbeats in daemon mode")
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon(args.interval)
+    else:
+        try:
+            with metrics.timer("total"):
+                heartbeat()
+        finally:
+            metrics.write_textfile(METRICS_DIR, "heartbeat")
 
 
 if __name__ == '__main__':
@@ -59,6 +59,8 @@ int packet_size = PacketSize;
 int phase_num = 3;
 int probe_num = ProbeNum;
 FILE * trace_fp = NULL;
+/* write results and per-train traces as JSON lines to stdout */
+int json_out = 0;
 int verbose = 0;
 int debug = 0;
 
@@ -110,7 +112,7 @@ struct trace_item * cur_trace = NULL;
 void Usage() {
     printf("IGI/PTR-%s client usage:\n\n", version);
     printf("\tptr-client [-n probe_num] [-s packet_size] [-p dst_port]\n");
-    printf("\t           [-k repeat_num] [-f trace_file] [-vdh] dst_address\n\n");
+    printf("\t           [-k repeat_num] [-f trace_file] [-jvdh] dst_address\n\n");
     printf("\t-n      set the number of probing packets in each train [60]\n");
     printf("\t-s      set the length of the probing packets in byte [500B]\n");
     printf("\t-p      indicate the dst machine's listening port [10241]\n");
@@ -118,6 +120,7 @@ void Usage() {
     printf("\t        that the igi_server is using.\n");
     printf("\t-k      the number of train probed for each source gap [3]\n");
     printf("\t-f      dump packet-level trace into trace_file\n");
+    printf("\t-j      write results and packet-level traces as JSON lines to stdout\n");
     printf("\t-v      verbose mode.\n");
     printf("\t-d      debug mode.\n");
     printf("\t-h      print this message.\n");
@@ -191,6 +194,33 @@ void dump_trace()
 }
 
 
+/* dump out one probing train as a JSON line */
+void dump_trace_json(struct trace_item * p, int index)
+{
+	int i;
+
+	printf("{\"type\": \"phase\", \"phase\": %d, \"probe_num\": %d, "
+	       "\"packet_size\": %d, \"delay_num\": %d, \"avg_src_gap\": %f, "
+	       "\"avg_dst_gap\": %f, \"b_bw\": %.3f, \"c_bw\": %.3f, "
+	       "\"a_bw\": %.3f, \"ptr\": %.3f, \"send_gaps\": [",
+	       index, p->probe_num, p->packet_size, p->delay_num,
+	       p->avg_src_gap, p->avg_dst_gap, p->b_bw, p->c_bw, p->a_bw, p->ptr);
+	for (i=1; i<p->probe_num; i++) {
+	    printf("%s%f", i > 1 ? ", " : "",
+		    p->send_times[i] - p->send_times[i-1]);
+	}
+	printf("], \"recv_gaps\": [");
+	for (i=0; i<p->record_count-1; i++) {
+	    printf("%s[%f, %d]", i > 0 ? ", " : "",
+		    get_rcd_time(p->rcv_record[i+1]) -
+		    get_rcd_time(p->rcv_record[i]),
+		    p->rcv_record[i+1].seq);
+	}
+	printf("]}\n");
+	fflush(stdout);
+}
+
+
 /* make a clean exit on interrupts */
 RETSIGTYPE cleanup(int signo)
 {
@@ -213,6 +243,9 @@ RETSIGTYPE cleanup(int signo)
 }
 
 void quit() {
+	if (json_out) {
+	    printf("{\"type\": \"error\", \"error\": \"CONNECTION FAILED\"}\n");
+	}
 	fflush(stdout);
 	fflush(stderr);
 	cleanup(1);
@@ -279,11 +312,21 @@ int get_delay_num(double gap)
 
 void dump_bandwidth()
 {
-	printf("\nPTR: %7.3f Mpbs (suggested)\n", PTR_bw / 1000000);
-	printf("IGI: %7.3f Mpbs\n", a_bw / 1000000);
-	printf("Probing uses %.3f seconds, %d trains, ending at a gap value of %d us.\n", probing_end_time - probing_start_time,
-		probing_phase_count,
-	    	(int)(tlt_dst_gap * 1000000));
+	if (json_out) {
+	    printf("{\"type\": \"bandwidth\", \"bottleneck_bw\": %.3f, "
+		   "\"competing_bw\": %.3f, \"ptr\": %.3f, \"available_bw\": %.3f, "
+		   "\"duration\": %.6f, \"trains\": %d, \"gap_us\": %d}\n",
+		   b_bw, competing_bw, PTR_bw, a_bw,
+		   probing_end_time - probing_start_time, probing_phase_count,
+		   (int)(tlt_dst_gap * 1000000));
+	    fflush(stdout);
+	} else {
+	    printf("\nPTR: %7.3f Mpbs (suggested)\n", PTR_bw / 1000000);
+	    printf("IGI: %7.3f Mpbs\n", a_bw / 1000000);
+	    printf("Probing uses %.3f seconds, %d trains, ending at a gap value of %d us.\n", probing_end_time - probing_start_time,
+		    probing_phase_count,
+		    (int)(tlt_dst_gap * 1000000));
+	}
 	if (trace_fp != NULL) {
 	    fprintf(trace_fp, "%%Bottleneck Bandwidth: %7.3f Mbps\n", b_bw / 1000000);
 	    fprintf(trace_fp, "%%Competing  Bandwidth: %7.3f Mpbs\n", competing_bw / 1000000);
@@ -487,6 +530,9 @@ void init_connection()
                 if (trace_fp != NULL) {
 		            fprintf(trace_fp, "CONNECTION FAILED");
 			    }
+                if (json_out) {
+                    printf("{\"type\": \"error\", \"error\": \"CONNECTION FAILED\"}\n");
+                }
                 exit(0);
             }
     }
@@ -691,7 +737,7 @@ int get_dst_gaps(struct pkt_rcd_t * rcv_record)
 	    ptr += sizeof(struct pkt_rcd_t);
 	}
 	msg_len -= data_size;
-	if (trace_fp != NULL) {
+	if (trace_fp != NULL || json_out) {
 	    memcpy(cur_trace->rcv_record, rcv_record, data_size);
 	    cur_trace->record_count = total_count;
 	}
@@ -842,7 +888,7 @@ void one_phase_probing()
 		    probe_num, packet_size, delay_num);
 	/* probing */
   	send_packets(probe_num, packet_size, delay_num, send_times);
-	if (trace_fp != NULL) {
+	if (trace_fp != NULL || json_out) {
 	    /* create a new trace item */
 	    cur_trace = (struct trace_item *)malloc(sizeof(struct trace_item));
 	    cur_trace->next = NULL;
@@ -885,7 +931,7 @@ void one_phase_probing()
 	    	tlt_src_gap * 1000000, tlt_dst_gap * 1000000,
 	    	avg_src_gap * 1000000, avg_dst_gap * 1000000);
 
-	if (trace_fp != NULL) {
+	if (trace_fp != NULL || json_out) {
 	    double tmp1, tmp2, tmp3;
 
 	    cur_trace->probe_num = probe_num;
@@ -915,6 +961,8 @@ void one_phase_probing()
 	    PTR_bw = tmp1;
 	    competing_bw = tmp2;
 	    a_bw = tmp3;
+	    if (json_out)
+		    dump_trace_json(cur_trace, probing_phase_count + 1);
 	}
 	probing_phase_count ++;
 }
@@ -1012,7 +1060,7 @@ int main(int argc, char *argv[])
 {
 	int opt;
 
-    while ((opt = getopt(argc, argv, "k:l:n:s:p:f:dhv")) != EOF) {
+    while ((opt = getopt(argc, argv, "k:l:n:s:p:f:jdhv")) != EOF) {
         switch ((char)opt) {
             case 'k':
 		        phase_num = atoi(optarg);
@@ -1043,6 +1091,9 @@ int main(int argc, char *argv[])
 		            exit(1);
 		        }
                 break;
+            case 'j':
+		        json_out = 1;
+                break;
             case 'd':
 		        debug = 1;
                 break;
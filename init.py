@@ -27,6 +27,7 @@ import json
 
 # SCION-Box
 from link_test import test_links
+import metrics
 import utils
 from heartbeat import heartbeat
 from defines import(
@@ -35,7 +36,8 @@ from defines import(
     CONNECT_URL,
     BOX_LOGFILE,
     FORMAT,
-    INTERFACE
+    INTERFACE,
+    METRICS_DIR,
 )
 
 
@@ -49,10 +51,12 @@ def init_box():
     # Find MAC and IP address
     ip_address = ni.ifaddresses(INTERFACE)[ni.AF_INET][0]['addr']
     mac_address = ni.ifaddresses(INTERFACE)[ni.AF_LINK][0]['addr']
-    conn_results = utils.test_connections()
+    with metrics.timer("port_scan"):
+        conn_results = utils.test_connections()
     logging.info("Connection test results: %s \n", str(conn_results))
     start_port, free_ports = utils.connection_results_2_free_ports(conn_results)
-    resp, err = call_init(mac_address, ip_address, start_port, free_ports)
+    with metrics.timer("coord_request", api="initBox"):
+        resp, err = call_init(mac_address, ip_address, start_port, free_ports)
     if err:
         logging.error("Failed to connect to SCION-COORD server: \n %s \n",err)
         exit(1)
@@ -65,14 +69,17 @@ def init_box():
             if not dict["PotentialNeighbors"]:
                logging.info("no potential Neighbors !")
                exit(1)
-            connection_results = test_links(dict["PotentialNeighbors"])
+            with metrics.timer("link_test"):
+                connection_results = test_links(dict["PotentialNeighbors"])
             dict["PotentialNeighbors"] = connection_results
             connect_box(dict)
         elif resp.headers['content-type'] == 'application/gzip':
             logging.info("Received gen folder ")
-            utils.parse_response(resp)
+            with metrics.timer("gen_extract"):
+                utils.parse_response(resp)
             logging.info("Starting SCION !")
-            utils.start_scion()
+            with metrics.timer("scion_start"):
+                utils.start_scion()
         else:
             # Received something else
             # TODO UPDATE ?
@@ -88,15 +95,18 @@ def connect_box(dictionary):
     and starts SCION
     :param dictionary: Dictionary with the connection results + credentials
     """
-    resp, err = call_connect(dictionary)
+    with metrics.timer("coord_request", api="connectBox"):
+        resp, err = call_connect(dictionary)
     if err:
         logging.error("Failed to connect to SCION-COORD server: %s" % err)
         exit(1)
     elif resp.headers['content-type'] == 'application/gzip':
         logging.info("Received gen folder ")
-        utils.parse_response(resp)
+        with metrics.timer("gen_extract"):
+            utils.parse_response(resp)
         logging.info("Starting SCION !")
-        utils.start_scion()
+        with metrics.timer("scion_start"):
+            utils.start_scion()
         exit(0)
     else:
         logging.error("Did not receive gen folder %s", resp.headers['content-type'])
@@ -115,7 +125,7 @@ def call_init(mac_address, ip_address, start_port, free_ports):
     init_dict = {'IPAddress': ip_address, 'MacAddress': mac_address, 'OpenPorts': free_ports, 'StartPort': start_port}
     logging.info("Calling coordinator at url: %s, with dict: %s", url, str(init_dict))
     try:
-        resp = requests.post(url, json=init_dict, timeout=10)
+        resp = requests.post(url, json=init_dict, timeout=10, stream=True)
     except requests.exceptions.RequestException as e:
         return None, e
     return resp, None
@@ -132,14 +142,18 @@ def call_connect(dictionary):
     url = POST_REQ
     logging.info("Calling coordinator at url: %s, with dict: %s", POST_REQ, str(connect_query))
     try:
-        resp = requests.post(url, json=connect_query, timeout=10)
+        resp = requests.post(url, json=connect_query, timeout=10, stream=True)
     except requests.exceptions.RequestException as e:
         return None, e
     return resp, None
 
 
 def main():
-    init_box()
+    try:
+        with metrics.timer("total"):
+            init_box()
+    finally:
+        metrics.write_textfile(METRICS_DIR, "init")
 
 if __name__ == '__main__':
     main()
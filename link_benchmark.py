@@ -0,0 +1,206 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`link_benchmark.py` --- Loopback benchmark of the measurement stack
+==============================================================================
+
+Starts the RTT server and a bandwidth server on localhost, simulates N
+potential neighbors on distinct loopback addresses and records wall time,
+CPU time, peak RSS and the number of threads of a full test_links() run.
+
+Usage: python3 link_benchmark.py [-n 10 100 1000] [-o link_benchmark.json]
+"""
+# Stdlib
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+# SCION-Box
+from link_test import test_links
+from defines import(
+    LINK_TEST_WORKERS,
+    LINK_TEST_NEIGHBOR_BUDGET,
+    LINK_TEST_BUDGET,
+)
+
+#: Default numbers of simulated neighbors
+NEIGHBOR_COUNTS = [10, 100, 1000]
+#: Seconds between two samples of RSS and thread count
+SAMPLE_INTERVAL = 0.05
+#: Seconds the servers get to bind their ports
+SERVER_STARTUP = 1
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Samples the RSS and the number of threads of this process until stopped
+    """
+    def __init__(self):
+        super(ResourceSampler, self).__init__(daemon=True)
+        self.stopped = threading.Event()
+        self.peak_rss_kb = 0
+        self.max_threads = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(SAMPLE_INTERVAL)
+
+    def sample(self):
+        self.peak_rss_kb = max(self.peak_rss_kb, _current_rss_kb())
+        # do not count the sampler itself
+        self.max_threads = max(self.max_threads, threading.active_count() - 1)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def _current_rss_kb():
+    """
+    :return: resident set size of this process in kB
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # no procfs, fall back to the peak over the whole process lifetime
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def simulated_neighbors(count):
+    """
+    Builds a list of potential neighbors on distinct loopback addresses
+    :param count: number of neighbors
+    :return: list of neighbor dictionaries as received from the SCION-COORD
+    """
+    neighbors = []
+    for i in range(count):
+        ip = "127.%d.%d.%d" % ((i + 1) >> 16 & 0xff, (i + 1) >> 8 & 0xff, (i + 1) & 0xff)
+        neighbors.append({"ISD_ID": "1", "AS_ID": str(1000 + i), "IP": ip})
+    return neighbors
+
+
+def start_servers(ptr_server):
+    """
+    Starts the RTT server and the bandwidth server in separate processes, so
+    that their CPU usage is not accounted to the measured client
+    :param ptr_server: command of the bandwidth server
+    :return: list of server processes
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    servers = [
+        # the simulated neighbors are spread over 127.0.0.0/8
+        subprocess.Popen([sys.executable, os.path.join(here, "rtt_test.py"), "0.0.0.0"],
+                         cwd=here, stdout=subprocess.DEVNULL),
+        subprocess.Popen(ptr_server, cwd=here, stdout=subprocess.DEVNULL),
+    ]
+    time.sleep(SERVER_STARTUP)
+    return servers
+
+
+def run_benchmark(count, workers, neighbor_budget, budget):
+    """
+    Runs test_links() against `count` simulated neighbors
+    :return: dictionary with the recorded metrics
+    """
+    neighbors = simulated_neighbors(count)
+    sampler = ResourceSampler()
+    sampler.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    results = test_links(neighbors, workers=workers, neighbor_budget=neighbor_budget,
+                         budget=budget, use_cache=False)
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    sampler.stop()
+    return {
+        "neighbors": count,
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "peak_rss_kb": sampler.peak_rss_kb,
+        "max_threads": sampler.max_threads,
+        "bw_measured": sum(1 for nb in results if nb["BW"] != -1),
+        "rtt_measured": sum(1 for nb in results if nb["RTT"] != -1),
+    }
+
+
+def _revision():
+    """
+    :return: git revision of the benchmarked tree, None if unknown
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here,
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of test_links()")
+    parser.add_argument("-n", "--neighbors", type=int, nargs="+", default=NEIGHBOR_COUNTS,
+                        help="numbers of simulated neighbors")
+    parser.add_argument("-o", "--output", default="link_benchmark.json",
+                        help="file the JSON results are written to")
+    parser.add_argument("-w", "--workers", type=int, default=LINK_TEST_WORKERS)
+    parser.add_argument("--neighbor-budget", type=float, default=LINK_TEST_NEIGHBOR_BUDGET)
+    parser.add_argument("--budget", type=float, default=LINK_TEST_BUDGET)
+    parser.add_argument("--ptr-server", default=None,
+                        help="bandwidth server command (default: python3 ptr_test.py)")
+    args = parser.parse_args()
+
+    ptr_server = [sys.executable, "ptr_test.py"]
+    if args.ptr_server:
+        ptr_server = args.ptr_server.split()
+    servers = start_servers(ptr_server)
+    runs = []
+    try:
+        for count in args.neighbors:
+            run = run_benchmark(count, args.workers, args.neighbor_budget, args.budget)
+            print("%(neighbors)5d neighbors: %(wall_time)8.2fs wall %(cpu_time)8.2fs cpu "
+                  "%(peak_rss_kb)8d kB rss %(max_threads)4d threads" % run)
+            runs.append(run)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    report = {
+        "revision": _revision(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workers": args.workers,
+        "neighbor_budget": args.neighbor_budget,
+        "budget": args.budget,
+        "ptr_server": " ".join(ptr_server),
+        "runs": runs,
+    }
+    with open(args.output, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`link_cache.py` --- Persistent cache of link test results
+==============================================================================
+
+Keeps the BW/RTT results of recently measured neighbors, keyed by their IP
+address, so that a re-init only probes neighbors that are new or stale.
+"""
+# Stdlib
+from collections import OrderedDict
+import json
+import logging
+import os
+import time
+
+# SCION-Box
+from defines import(
+    LINK_CACHE_FILE,
+    LINK_CACHE_TTL,
+    LINK_CACHE_SIZE,
+)
+
+
+class LinkCache(object):
+    """
+    TTL cache of neighbor measurements with size-bounded eviction. Entries
+    are kept in insertion order, the oldest measurement is evicted first.
+    """
+    def __init__(self, path=LINK_CACHE_FILE, ttl=LINK_CACHE_TTL, size=LINK_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+
+    def load(self):
+        """
+        Loads the cache file, a missing or broken file gives an empty cache
+        """
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logging.debug("Not using link cache %s: %s", self.path, e)
+            return
+        if not isinstance(entries, dict):
+            logging.debug("Not using link cache %s: not an object", self.path)
+            return
+        valid = []
+        for ip, entry in entries.items():
+            if _valid_entry(entry):
+                valid.append((ip, entry))
+            else:
+                logging.debug("Skipping malformed link cache entry of %s", ip)
+        for ip, entry in sorted(valid, key=lambda item: item[1]["Time"]):
+            self.entries[ip] = entry
+        self._evict()
+
+    def save(self):
+        """
+        Writes the cache file, the old file is replaced atomically
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(tmp_path, self.path)
+
+    def get(self, ip):
+        """
+        :param ip: IP address of the neighbor
+        :return: the cached measurement results, None if missing or stale
+        """
+        entry = self.entries.get(ip)
+        if entry is None:
+            return None
+        if time.time() - entry["Time"] > self.ttl:
+            del self.entries[ip]
+            return None
+        return entry["Result"]
+
+    def put(self, ip, result):
+        """
+        Stores the measurement results of a neighbor
+        :param ip: IP address of the neighbor
+        :param result: dictionary of measurement results (BW, RTT, ...)
+        """
+        self.entries.pop(ip, None)
+        self.entries[ip] = {"Time": time.time(), "Result": result}
+        self._evict()
+
+    def _evict(self):
+        now = time.time()
+        for ip in [ip for ip, entry in self.entries.items()
+                   if now - entry["Time"] > self.ttl]:
+            del self.entries[ip]
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def _valid_entry(entry):
+    """
+    :returns: True if entry is a cache entry as written by LinkCache.put()
+    """
+    return (isinstance(entry, dict) and isinstance(entry.get("Time"), (int, float)) and
+            isinstance(entry.get("Result"), dict))
@@ -18,121 +18,267 @@
 This file is located where igi_client is located
 """
 # Stdlib
-from subprocess import call
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+import json
 import logging
+import queue
 import threading
+import time
 
 # SCION-Box
-from rtt_test import rtt_client
+import metrics
+from rtt_test import rtt_measure, rtt_measure_udp
+from ptr_test import ptr_client
+from link_cache import LinkCache
 from defines import(
     PTR_SERVER_PORT,
     PTR_PATH_CLIENT,
-    OUTPUT_PATH_CLIENT,
     REPETITIONS,
+    BW_TEST_ENGINE,
+    RTT_PROBE_MODE,
+    LINK_TEST_WORKERS,
+    LINK_TEST_NEIGHBOR_BUDGET,
+    LINK_TEST_BUDGET,
+    LINK_TEST_GRACE,
 )
 
 
-m_list = []
-
-
-def test_links(Potential_Neighbors):
+def test_links(Potential_Neighbors, workers=LINK_TEST_WORKERS,
+               neighbor_budget=LINK_TEST_NEIGHBOR_BUDGET, budget=LINK_TEST_BUDGET,
+               use_cache=True):
     """
     Runs connection tests to each potential neighbor.
+    At most `workers` neighbors are measured at the same time, each of them
+    within `neighbor_budget` seconds. After `budget` seconds the results
+    collected so far are returned, unfinished neighbors report BW and RTT -1.
+    Neighbors with a fresh entry in the link cache are not probed again.
     :param: List of potential neighbor IP addresses
             [{AS_ID: "1",ISD_ID: "1", IP: "135.251.53.1"},
 			{AS_ID: "6",ISD_ID: "1", IP: "13.2.53.1"}]
+    :param workers: maximal number of concurrent measurements
+    :param neighbor_budget: seconds available for one neighbor
+    :param budget: seconds available for the whole run
+    :param use_cache: reuse and store results in the link cache
     :return: List like above but with BW: and RTT:
     """
     logging.info("Running connection test for neighbors:%s", str(Potential_Neighbors))
-    threads = []
-    for i,nb in enumerate(Potential_Neighbors):
-        t = threading.Thread(target=connection_test, args=(nb,))
-        threads.append(t)
+    deadline = time.monotonic() + budget
+    cache = LinkCache()
+    if use_cache:
+        cache.load()
+    jobs = queue.Queue()
+    results = [None] * len(Potential_Neighbors)
+    cached = set()
+    for i, nb in enumerate(Potential_Neighbors):
+        entry = cache.get(nb["IP"])
+        if entry is not None:
+            results[i] = dict(nb, **entry)
+            cached.add(i)
+        else:
+            jobs.put((i, nb))
+    logging.info("Reusing %d cached measurements, probing %d neighbors",
+                 len(Potential_Neighbors) - jobs.qsize(), jobs.qsize())
+    metrics.inc("link_test_neighbors", len(cached), result="cached")
+    finished = threading.Condition()
+
+    def worker():
+        while True:
+            try:
+                i, nb = jobs.get_nowait()
+            except queue.Empty:
+                return
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            result = connection_test(nb, min(deadline, now + neighbor_budget))
+            with finished:
+                results[i] = result
+                finished.notify()
 
-    for t in threads:
-        t.start()
+    # Daemon threads: a stuck measurement must not keep the box from exiting
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(min(workers, jobs.qsize()))]
+    for thread in threads:
+        thread.start()
 
-    for t in threads:
-        t.join()
+    with finished:
+        finished.wait_for(lambda: None not in results,
+                          timeout=max(0, deadline - time.monotonic()))
+        m_list = list(results)
+    # every measurement checks the deadline before each blocking operation,
+    # so the workers end shortly after it
+    join_end = deadline + LINK_TEST_GRACE
+    for thread in threads:
+        thread.join(max(0, join_end - time.monotonic()))
+    if any(thread.is_alive() for thread in threads):
+        logging.warning("Link test workers still running after the time budget")
+    for i, nb in enumerate(Potential_Neighbors):
+        if m_list[i] is None:
+            logging.warning("No measurement for %s within the time budget", nb["IP"])
+            m_list[i] = dict(nb, BW=-1, RTT=-1)
+            metrics.inc("link_test_neighbors", result="timeout")
+        elif i in cached:
+            # reused entries keep their timestamp, so they still expire
+            continue
+        elif m_list[i]["BW"] != -1 and m_list[i]["RTT"] != -1:
+            # only successful measurements are cached, failures are retried
+            metrics.inc("link_test_neighbors", result="measured")
+            cache.put(nb["IP"], {k: v for k, v in m_list[i].items() if k not in nb})
+        else:
+            metrics.inc("link_test_neighbors", result="failed")
+    if use_cache:
+        try:
+            cache.save()
+        except OSError as e:
+            logging.error("Unable to save the link cache: %s", e)
 
     logging.info("[INFO] Measurements: %s", str(m_list))
     return m_list
 
 
-def connection_test(nb):
+def connection_test(nb, deadline=None):
     """
     Runs RTT & BW tests for one neighbor
     :param nb: dictionary of the pot. Neighbor
+    :param deadline: time.monotonic() value by which the tests have to finish
+    :return: copy of nb with the measurement results
     """
+    nb = dict(nb)
     IP = nb["IP"]
-    bw = bw_test(IP)
+    with metrics.timer("link_test_bw") as run:
+        bw = bw_test(IP, deadline)
+        run.failed = bw == -1
     nb["BW"] = bw
-    rtt = rtt_test(IP)
-    nb["RTT"] = rtt
-    m_list.append(nb)
+    with metrics.timer("link_test_rtt") as run:
+        stats = rtt_test(IP, deadline)
+        run.failed = stats is None
+    if stats is None:
+        nb["RTT"] = -1
+    else:
+        # RTT stays the best case, the distribution describes link quality
+        nb["RTT"] = stats["min"]
+        nb["RTTMedian"] = stats["median"]
+        nb["RTTP95"] = stats["p95"]
+        nb["RTTJitter"] = stats["jitter"]
+        nb["RTTLoss"] = stats["loss"]
+    return nb
 
 
-def _get_output_file(ip_address):
+def _remaining(deadline):
     """
-    Opens the BW test output File
-    :param ip_address: address to which BW was measured
-    :return: The opened File
+    Seconds left until the deadline
+    :param deadline: time.monotonic() value or None for no deadline
+    :return: remaining seconds (at least 0), None if there is no deadline
     """
-    fn = OUTPUT_PATH_CLIENT + str(ip_address) + ".txt"
-    try:
-        file = open(fn, 'r')
-    except IOError:
-        file = open(fn, 'w')
-    file.close()
-    return fn
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+def bw_test(ip_address, deadline=None):
+    """
+    Estimates the bandwidth with the engine selected by BW_TEST_ENGINE
+    :param ip_address: string of the IP address to which we test the connection
+    :param deadline: time.monotonic() value by which the test has to finish
+    :return: the packet transmit rate in MB/s, -1 on failure
+    """
+    if BW_TEST_ENGINE == "native":
+        return _bw_test_native(ip_address, deadline)
+    return _bw_test_ptr_client(ip_address, deadline)
+
+
+def _bw_test_native(ip_address, deadline=None):
+    """
+    Runs the IGI/PTR algorithm of ptr_test against the ptr server of the
+    neighbor in this process. Failed probing runs are repeated up to
+    REPETITIONS-1 times while the deadline allows it.
+    :param ip_address: string of the IP address to which we test the connection
+    :param deadline: time.monotonic() value by which the test has to finish
+    :return: the packet transmit rate in MB/s, -1 if no run succeeded
+    """
+    for i in range(0,REPETITIONS-1):
+        if _remaining(deadline) == 0:
+            break
+        result = ptr_client(ip_address, deadline=deadline)
+        if result is not None:
+            return result["ptr"] / 1000000 / 8
+    return -1
 
 
-def bw_test(ip_address):
+def _bw_test_ptr_client(ip_address, deadline=None):
     """
     Calls a modified version of igi-udp, If there is an error we retry 5 times
     if no succes the returned value is -1.
     :param ip_address: string of the IP address to which we test the connection
-    :return: int bw: the bottelneck bw estimated by igi-udp.
+    :param deadline: time.monotonic() value by which the test has to finish
+    :return: the packet transmit rate in MB/s
     """
-    igi_udp_path = PTR_PATH_CLIENT
     for i in range(0,REPETITIONS-1):
-        call([igi_udp_path, "-p " + str(PTR_SERVER_PORT), "-f" + _get_output_file(ip_address), ip_address])
-        f = open(_get_output_file(ip_address))
-        for line in f:
-            if "CONNECTION FAILED" in line:
-                break
-            if "Packet Transmit Rate:" in line:
-                bw = _get_bw(line)
-                return bw/8
+        if _remaining(deadline) == 0:
+            break
+        try:
+            bandwidth, phases = ptr_client_stream(ip_address, deadline)
+        except TimeoutExpired:
+            logging.warning("BW test to %s exceeded its time budget", ip_address)
+            break
+        logging.debug("BW test to %s: %s probing trains", ip_address, len(phases))
+        if bandwidth is not None:
+            return bandwidth["ptr"] / 1000000 / 8
     return -1
 
 
-def _get_bw(line):
+def ptr_client_stream(ip_address, deadline=None):
     """
-    Extracts the BW from the string of the Form
-    Bottleneck Bandwidth: bw
-    :param line: string in which the bw is saved
-    :return: int bw
+    Runs ptr-client in JSON mode and reads its results through a pipe
+    :param ip_address: string of the IP address to which we test the connection
+    :param deadline: time.monotonic() value by which the test has to finish
+    :return: the bandwidth record (None if probing failed) and the list of
+             per-train trace records
     """
-    index = line.index(":")
-    bw = ""
-    for c in line[index+1:]:
-        if c != " " and c!= "\n":
-            if c == "M":
-                break
-            bw = bw + c
-    return float(bw)
+    proc = Popen([PTR_PATH_CLIENT, "-j", "-p", str(PTR_SERVER_PORT), ip_address],
+                 stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
+    try:
+        out, _ = proc.communicate(timeout=_remaining(deadline))
+    except TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+    bandwidth = None
+    phases = []
+    for line in out.splitlines():
+        # ptr-client still prints its diagnostics as plain text
+        if not line.startswith("{"):
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record["type"] == "phase":
+            phases.append(record)
+        elif record["type"] == "bandwidth":
+            bandwidth = record
+    return bandwidth, phases
 
 
-def rtt_test(ip_address):
+def rtt_test(ip_address, deadline=None):
     """
     Uses Pings to determine the RTT of the connection
     :param ip_address:
-    :return: int rtt
+    :param deadline: time.monotonic() value by which the test has to finish
+    :return: dictionary of RTT statistics, None if the neighbor is unreachable
     """
+    stats = None
+    if RTT_PROBE_MODE == "udp":
+        stats = rtt_measure_udp(ip_address, deadline=deadline)
+        if stats is not None:
+            return stats
+        # The neighbor may run an rtt server without UDP support
+        logging.info("No UDP RTT replies from %s, falling back to TCP", ip_address)
     for i in range(0,REPETITIONS-1):
-        r = rtt_client(ip_address)
-        if r != -1:
+        if _remaining(deadline) == 0:
+            break
+        stats = rtt_measure(ip_address, deadline=deadline)
+        if stats is not None:
             break
-    return r
+    return stats
 
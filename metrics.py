@@ -0,0 +1,176 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`metrics.py` --- Phase timers and counters in Prometheus text format
+==============================================================================
+"""
+# Stdlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+#: Prefix of all metric names
+METRIC_PREFIX = "scionbox"
+#: Textfile directory of the Debian/Ubuntu node exporter package, default of
+#: METRICS_DIR in defines.py (box) and update_gen.py (attachment point)
+DEFAULT_METRICS_DIR = "/var/lib/prometheus/node-exporter"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    return "{%s}" % ",".join('%s="%s"' % (key, _escape(value)) for key, value in labels)
+
+
+class _Run(object):
+    """
+    Outcome of a run measured by Metrics.timer()
+    """
+    def __init__(self):
+        self.failed = False
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of phase durations and counters
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (phase, labels) -> [count, sum, max, last, failures]
+        self._phases = {}
+        # (name, labels) -> value
+        self._counters = {}
+
+    @contextmanager
+    def timer(self, phase, **labels):
+        """
+        Measures the duration of the with block, an exception or an exit
+        with an error code counts as a failure of the phase. The block can
+        mark a run that failed without an exception:
+
+            with metrics.timer("link_test_bw") as run:
+                run.failed = bw_test(ip) == -1
+        """
+        start = time.monotonic()
+        run = _Run()
+        failed = False
+        try:
+            yield run
+        except SystemExit as e:
+            failed = e.code not in (None, 0)
+            raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.observe(phase, time.monotonic() - start, failed or run.failed, **labels)
+
+    def observe(self, phase, seconds, failed=False, **labels):
+        """
+        Records one run of a phase
+        :param str phase: name of the phase
+        :param float seconds: duration of the run
+        :param bool failed: the run ended with an error
+        """
+        key = (phase, tuple(sorted(labels.items())))
+        with self._lock:
+            stats = self._phases.get(key)
+            if stats is None:
+                stats = self._phases[key] = [0, 0.0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] = seconds
+            if failed:
+                stats[4] += 1
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to the counter name
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self, program):
+        """
+        :param str program: value of the program label of all metrics
+        :returns: the recorded metrics in Prometheus text format
+        """
+        with self._lock:
+            phases = sorted((key, list(stats)) for key, stats in self._phases.items())
+            counters = sorted(self._counters.items())
+        base = (('program', program),)
+        lines = []
+        # the summary has no quantiles, its _sum and _count give the mean
+        for suffix, kind, samples, help_text in (
+                ("phase_duration_seconds", "summary", (("_sum", 1), ("_count", 0)),
+                 "Seconds spent in the phase"),
+                ("phase_max_duration_seconds", "gauge", (("", 2),), "Longest run of the phase"),
+                ("phase_last_duration_seconds", "gauge", (("", 3),), "Duration of the last run"),
+                ("phase_failures_total", "counter", (("", 4),), "Runs of the phase that failed")):
+            name = "%s_%s" % (METRIC_PREFIX, suffix)
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (phase, labels), stats in phases:
+                for sample, index in samples:
+                    lines.append("%s%s%s %s" % (name, sample,
+                                                _labels(base + (('phase', phase),) + labels),
+                                                repr(stats[index])))
+        names = sorted(set(name for (name, _), _ in counters))
+        for counter in names:
+            name = "%s_%s_total" % (METRIC_PREFIX, counter)
+            lines.append("# TYPE %s counter" % name)
+            for (other, labels), value in counters:
+                if other == counter:
+                    lines.append("%s%s %s" % (name, _labels(base + labels), repr(value)))
+        name = "%s_last_run_timestamp_seconds" % METRIC_PREFIX
+        lines.append("# TYPE %s gauge" % name)
+        lines.append("%s%s %s" % (name, _labels(base), repr(time.time())))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, directory, program):
+        """
+        Atomically replaces <directory>/<program>.prom with the recorded
+        metrics. Nothing is written if the directory does not exist or is not
+        writable, i.e. no node exporter runs. Errors are logged, metrics never
+        break a run.
+        :param str directory: directory of the node exporter textfile collector
+        :param str program: name of the program, see render()
+        """
+        if not directory or not os.access(directory, os.W_OK):
+            return
+        path = os.path.join(directory, "%s.prom" % program)
+        # the collector only reads *.prom files, so it never sees the temp file
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as prom_file:
+                prom_file.write(self.render(program))
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error("Unable to write the metrics to %s: %s", path, e)
+
+
+#: Registry of this process
+_registry = Metrics()
+timer = _registry.timer
+observe = _registry.observe
+inc = _registry.inc
+render = _registry.render
+write_textfile = _registry.write_textfile
@@ -0,0 +1,269 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`port_scan.py` --- In-process scan of the UDP ports open for inbound traffic
+==============================================================================
+
+Binds each candidate port, sends a probe from it to a UDP reflector and
+waits for the reflection. The reflector answers from a different port than
+the one it was probed on, so only ports that accept inbound traffic pass.
+
+Running this file starts a stand-in reflector:
+    python3 port_scan.py [port]
+"""
+# Stdlib
+import asyncio
+import logging
+import os
+import socket
+import struct
+import sys
+
+# SCION-Box
+from defines import(
+    UDP_REFLECTOR_PORT,
+    PORT_SCAN_PARALLELISM,
+    PORT_SCAN_TIMEOUT,
+    PORT_SCAN_STRIDE,
+    PORT_SCAN_MAX_PORTS,
+    PORT_SCAN_MAX_PROBES,
+)
+
+#: Probe and reflection: magic, token, probed port
+PROBE_FORMAT = struct.Struct("!4sQH")
+PROBE_MAGIC = b"SBPS"
+
+
+class UDPReflector(object):
+    """
+    Endpoint that reflects probes back to the port they were sent from.
+    Subclass it to scan against a reflector speaking another protocol.
+    """
+    def __init__(self, host, port=UDP_REFLECTOR_PORT):
+        self.host = host
+        self.port = port
+        self.addr = None
+
+    def resolve(self):
+        """
+        Looks up the address of the reflector once per scan
+        """
+        info = socket.getaddrinfo(self.host, self.port, socket.AF_INET, socket.SOCK_DGRAM)
+        self.addr = info[0][4]
+
+    def probe(self, token, port):
+        """
+        :returns: the datagram asking for a reflection to port
+        """
+        return PROBE_FORMAT.pack(PROBE_MAGIC, token, port)
+
+    def is_reflection(self, data, token, port):
+        """
+        :returns: True if data is the reflection of the probe
+        """
+        return data == self.probe(token, port)
+
+
+class _ProbeProtocol(asyncio.DatagramProtocol):
+    """
+    Waits for the reflection on one probed port
+    """
+    def __init__(self, reflector, token, port, reflected):
+        self.reflector = reflector
+        self.token = token
+        self.port = port
+        self.reflected = reflected
+
+    def datagram_received(self, data, addr):
+        if (not self.reflected.done() and
+                self.reflector.is_reflection(data, self.token, self.port)):
+            self.reflected.set_result(True)
+
+    def error_received(self, exc):
+        # ICMP errors do not tell anything about inbound traffic
+        pass
+
+
+async def _probe_port(loop, reflector, port, token, timeout, semaphore):
+    """
+    :returns: True if the reflection arrived on port within timeout
+    """
+    async with semaphore:
+        reflected = loop.create_future()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _ProbeProtocol(reflector, token, port, reflected),
+                local_addr=('0.0.0.0', port))
+        except OSError as e:
+            logging.warning("Cannot bind UDP port %s: %s", port, e)
+            return False
+        probe = reflector.probe(token, port)
+        try:
+            transport.sendto(probe, reflector.addr)
+            # one more copy halfway through in case the first one got lost
+            loop.call_later(timeout / 2, _resend, transport, probe, reflector.addr)
+            await asyncio.wait_for(reflected, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            transport.close()
+
+
+def _resend(transport, probe, addr):
+    if not transport.is_closing():
+        transport.sendto(probe, addr)
+
+
+def _new_token():
+    return struct.unpack("!Q", os.urandom(8))[0]
+
+
+async def _scan(loop, reflector, ports, parallelism, timeout, token):
+    semaphore = asyncio.Semaphore(parallelism)
+    return await asyncio.gather(*[_probe_port(loop, reflector, port, token, timeout, semaphore)
+                                  for port in ports])
+
+
+def scan_ports(reflector, ports, parallelism=PORT_SCAN_PARALLELISM, timeout=PORT_SCAN_TIMEOUT):
+    """
+    Scans which of the ports are reachable from the outside over UDP
+    :param UDPReflector reflector: endpoint that reflects the probes
+    :param ports: list of local UDP ports
+    :param int parallelism: number of ports probed at the same time
+    :param float timeout: seconds to wait for the reflection
+    :return: list of connection results as returned by utils.test_connections
+    """
+    reflector.resolve()
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(_scan(loop, reflector, ports, parallelism, timeout,
+                                                _new_token()))
+    finally:
+        loop.close()
+    return [{'name': "udp_in", 'port': port, 'result': result}
+            for port, result in zip(ports, results)]
+
+
+def adaptive_scan(reflector, start, count, stride=PORT_SCAN_STRIDE, max_ports=PORT_SCAN_MAX_PORTS,
+                  max_probes=PORT_SCAN_MAX_PROBES, parallelism=PORT_SCAN_PARALLELISM,
+                  timeout=PORT_SCAN_TIMEOUT):
+    """
+    Scans for blocks of reachable UDP ports with fewer probes than
+    scan_ports(). Every stride-th port of the window is probed first, then
+    only the ports around the open samples. A block reaching the end of the
+    window is followed beyond it, up to max_ports above start. Blocks shorter
+    than stride can be missed, unless no sample is open at all, then the
+    whole window is probed. No more than max_probes ports are probed in
+    total, the ports around the samples come first.
+    :param UDPReflector reflector: endpoint that reflects the probes
+    :param int start: first port of the window
+    :param int count: number of ports in the window
+    :param int stride: distance of the sampled ports
+    :param int max_ports: number of ports above start the scan may reach
+    :param int max_probes: number of ports the scan may probe
+    :return: connection results of all probed ports, sorted by port
+    """
+    reflector.resolve()
+    loop = asyncio.new_event_loop()
+    token = _new_token()
+    results = {}
+
+    def probe(ports):
+        ports = [port for port in dict.fromkeys(ports) if port not in results]
+        del ports[max(0, max_probes - len(results)):]
+        if ports:
+            reached = loop.run_until_complete(_scan(loop, reflector, ports, parallelism,
+                                                    timeout, token))
+            results.update(zip(ports, reached))
+
+    try:
+        end = start + count
+        samples = range(start, end, stride)
+        probe(samples)
+        open_samples = [port for port in samples if results.get(port)]
+        if not open_samples:
+            probe(range(start, end))
+        else:
+            candidates = []
+            for sample in open_samples:
+                # the block of a sample can reach up to the neighbouring samples
+                candidates.extend(range(max(start, sample - stride + 1), min(end, sample + stride)))
+            probe(candidates)
+        limit = start + max_ports
+        step = stride
+        while results.get(end - 1) and end < limit and len(results) < max_probes:
+            probe(range(end, min(limit, end + step)))
+            end = min(limit, end + step)
+            step *= 2
+    finally:
+        loop.close()
+    return [{'name': "udp_in", 'port': port, 'result': results[port]} for port in sorted(results)]
+
+
+def open_port_ranges(results):
+    """
+    Finds the blocks of consecutive reachable ports
+    :param results: list of connection results
+    :return: list of (first port, number of ports), the largest block first
+    """
+    ranges = []
+    for port in sorted(result['port'] for result in results if result['result']):
+        if ranges and ranges[-1][0] + ranges[-1][1] == port:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([port, 1])
+    ranges.sort(key=lambda block: (-block[1], block[0]))
+    return [tuple(block) for block in ranges]
+
+
+class ReflectorServer(asyncio.DatagramProtocol):
+    """
+    Stand-in reflector, answers every probe from a second socket
+    """
+    def __init__(self, reply_sock):
+        self.reply_sock = reply_sock
+
+    def datagram_received(self, data, addr):
+        if len(data) != PROBE_FORMAT.size or data[:4] != PROBE_MAGIC:
+            return
+        try:
+            self.reply_sock.sendto(data, addr)
+        except OSError as e:
+            logging.error("Cannot reflect to %s: %s", addr, e)
+
+
+def reflector_server(port=UDP_REFLECTOR_PORT):
+    """
+    Runs the stand-in reflector until interrupted
+    """
+    loop = asyncio.new_event_loop()
+    reply_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    reply_sock.bind(('0.0.0.0', 0))
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: ReflectorServer(reply_sock), local_addr=('0.0.0.0', port)))
+    try:
+        loop.run_forever()
+    finally:
+        transport.close()
+        reply_sock.close()
+        loop.close()
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else UDP_REFLECTOR_PORT
+    reflector_server(port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`ptr_test.py` --- In-process IGI/PTR bandwidth estimation
+==============================================================================
+
+Python implementation of the igi-ptr-2.1 packet train probing. The client
+speaks the ptr-server protocol and computes the PTR/IGI estimates in memory,
+the server is a compatible stand-in for igi-ptr-2.1/ptr-server.
+
+Protocol (control over TCP, probes over UDP):
+    client -> server  $START$<probe_num>$
+    server -> client  $READY$$<udp port>$
+    client -> server  <probe_num> UDP packets, the first byte is the sequence
+                      number, followed by a short packet to <udp port>+1
+    server -> client  $<size>$ and <size> bytes of (sec, usec, seq) records
+"""
+# Stdlib
+import asyncio
+import logging
+import socket
+import struct
+import time
+
+# SCION-Box
+from defines import(
+    PTR_SERVER_PORT,
+)
+
+#: Probing parameters, same defaults as igi-ptr-2.1/src/common.h
+PROBE_NUM = 60
+PACKET_SIZE = 500
+MAX_PROBE_NUM = 256
+PHASE_NUM = 3
+#: Width of the histogram bins used to find the bottleneck gap (seconds)
+BIN_WIDTH = 0.000025
+#: Upper bound of probing phases, a run never sends more trains than this
+MAX_PHASE_NUM = 1024
+#: Seconds the server gets to set up its packet filter (as ptr-client does)
+STARTUP_WAIT = 2
+#: Seconds to wait for the control connection and each record batch
+CONTROL_TIMEOUT = 10
+#: Server: seconds after the last probe before a partial train is reported
+PHASE_WAIT = 1
+#: Server: seconds a client may stay silent before its session is dropped
+CLIENT_TIMEOUT = 30
+#: Record of one received probe: seconds, microseconds, sequence number
+RECORD_FORMAT = struct.Struct("!III")
+
+
+class PTRError(Exception):
+    """
+    Raised when a bandwidth probing session fails
+    """
+    pass
+
+
+def ptr_client(ip_address, port=PTR_SERVER_PORT, deadline=None,
+               probe_num=PROBE_NUM, packet_size=PACKET_SIZE, phase_num=PHASE_NUM):
+    """
+    Estimates the bandwidth to a ptr server with packet trains
+    :param ip_address: IP address of the potential neighbor
+    :param port: TCP control port of the ptr server
+    :param deadline: time.monotonic() value by which probing has to finish
+    :param probe_num: number of packets per train
+    :param packet_size: size of the probing packets in bytes
+    :param phase_num: number of trains probed for each gap value
+    :return: dictionary with the PTR, IGI and bottleneck bandwidth in bit/s
+             and the probing duration in seconds, None on failure
+    """
+    session = PTRSession(ip_address, port, deadline, min(probe_num, MAX_PROBE_NUM),
+                         packet_size, phase_num)
+    try:
+        session.connect()
+        return session.fast_probing()
+    except (socket.error, PTRError) as e:
+        logging.error("BW test to %s failed: %s", ip_address, e)
+        return None
+    finally:
+        session.close()
+
+
+class PTRSession(object):
+    """
+    One probing run of the IGI/PTR algorithm against a ptr server, the
+    computations follow igi-ptr-2.1/src/ptr-client.c
+    """
+    def __init__(self, ip_address, port, deadline, probe_num, packet_size, phase_num):
+        self.ip_address = ip_address
+        self.port = port
+        self.deadline = deadline
+        self.probe_num = probe_num
+        self.packet_size = packet_size
+        self.phase_num = phase_num
+        self.control_sock = None
+        self.probing_sock = None
+        self.probing_addr = None
+        self.junk_addr = None
+        self.buf = b""
+        # state of the current n-phase probing
+        self.b_bw = 0
+        self.ptr_bw = 0
+        self.a_bw = 0
+        self.tlt_src_gap = 0
+        self.tlt_dst_gap = 0
+        self.avg_dst_gap = 0
+        self.dst_gaps = []
+        self.total_count = 0
+        self.phase_count = 0
+
+    def _timeout(self):
+        if self.deadline is None:
+            return CONTROL_TIMEOUT
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise PTRError("time budget exceeded")
+        return min(CONTROL_TIMEOUT, remaining)
+
+    def connect(self):
+        """
+        Opens the control connection and waits for the server's probing port
+        """
+        self.control_sock = socket.create_connection((self.ip_address, self.port),
+                                                     timeout=self._timeout())
+        self.control_sock.sendall(("$START$%d$" % self.probe_num).encode())
+        if self._get_item() != "READY":
+            raise PTRError("unexpected answer when waiting for READY")
+        probing_port = int(self._get_item())
+        self.probing_addr = (self.ip_address, probing_port)
+        # the tail "junk" packet goes to the next port
+        self.junk_addr = (self.ip_address, probing_port + 1)
+        self.probing_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.probing_sock.bind(('', 0))
+        time.sleep(min(STARTUP_WAIT, self._timeout()))
+
+    def close(self):
+        for sock in (self.probing_sock, self.control_sock):
+            if sock is not None:
+                sock.close()
+
+    def _read(self):
+        self.control_sock.settimeout(self._timeout())
+        data = self.control_sock.recv(4096)
+        if not data:
+            raise PTRError("control connection closed")
+        self.buf += data
+
+    def _get_item(self):
+        """
+        Reads the next $<item>$ from the control channel
+        :return: the item as a string
+        """
+        while True:
+            if self.buf and self.buf[:1] != b"$":
+                raise PTRError("unknown message on the control channel")
+            end = self.buf.find(b"$", 1)
+            if end > 0:
+                item = self.buf[1:end].decode()
+                self.buf = self.buf[end + 1:]
+                return item
+            self._read()
+
+    def _get_records(self):
+        """
+        Reads the arrival records of one train from the server
+        :return: list of (arrival time, sequence number)
+        """
+        size = int(self._get_item())
+        while len(self.buf) < size:
+            self._read()
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return [(sec + u_sec / 1e6, seq)
+                for sec, u_sec, seq in RECORD_FORMAT.iter_unpack(data)]
+
+    def _send_train(self, gap):
+        """
+        Sends one packet train, consecutive packets leave `gap` seconds apart
+        :return: the send time of the first and the last packet
+        """
+        packet = bytearray(self.packet_size)
+        sock = self.probing_sock
+        first = None
+        for i in range(self.probe_num - 1):
+            now = time.perf_counter()
+            if first is None:
+                first = now
+            packet[0] = i & 0xff
+            sock.sendto(packet, self.probing_addr)
+            # busy wait, sleeping is far too coarse for sub-millisecond gaps
+            target = now + gap
+            while time.perf_counter() < target:
+                pass
+        packet[0] = (self.probe_num - 1) & 0xff
+        sock.sendto(packet, self.probing_addr)
+        sock.sendto(packet[:40], self.junk_addr)
+        last = time.perf_counter()
+        return first if first is not None else last, last
+
+    def _one_phase_probing(self, gap):
+        """
+        Sends one train and collects the in-order gaps observed at the server
+        :return: average source gap and average destination gap of the train
+        """
+        first, last = self._send_train(gap)
+        records = self._get_records()
+        self.total_count = len(records)
+        avg_src_gap = (last - first) / (self.probe_num - 1) if self.probe_num > 1 else 0
+        # only consider those gaps composed by two in-order packets
+        self.dst_gaps = [records[i + 1][0] - records[i][0]
+                         for i in range(len(records) - 1)
+                         if records[i + 1][1] - records[i][1] == 1]
+        if self.dst_gaps:
+            self.avg_dst_gap = sum(self.dst_gaps) / len(self.dst_gaps)
+        else:
+            self.avg_dst_gap = 0
+        self.tlt_src_gap += avg_src_gap
+        self.tlt_dst_gap += self.avg_dst_gap
+        self.phase_count += 1
+        return avg_src_gap
+
+    def _n_phase_probing(self, gap):
+        """
+        Probes phase_num trains with the same gap and updates the estimates
+        """
+        self.tlt_src_gap = 0
+        self.tlt_dst_gap = 0
+        c_bw = []
+        for i in range(self.phase_num):
+            avg_src_gap = self._one_phase_probing(gap)
+            if not self.dst_gaps:
+                competing_bw = 0
+            else:
+                if self.b_bw < 1:
+                    self.b_bw = get_bottleneck_bw(self.dst_gaps, self.packet_size)
+                competing_bw = get_competing_bw(self.dst_gaps, avg_src_gap,
+                                                self.b_bw, self.packet_size)
+            c_bw.append(competing_bw)
+        if self.tlt_dst_gap > 0:
+            self.ptr_bw = self.packet_size * 8 * self.phase_num / self.tlt_dst_gap
+        c_bw.sort()
+        self.a_bw = self.b_bw - c_bw[self.phase_num // 2]
+
+    def _gap_comp(self):
+        """
+        :return: True if the destination gap is still larger than the source gap
+        """
+        delta = 0.05
+        if self.tlt_dst_gap < self.tlt_src_gap / (1 + delta):
+            return False
+        return self.tlt_dst_gap > self.tlt_src_gap + 0.000005 * self.phase_num
+
+    def fast_probing(self):
+        """
+        Increases the source gap until it matches the destination gap, the
+        PTR measured at the turning point is the estimate
+        :return: dictionary with the estimates (see ptr_client)
+        """
+        start = time.perf_counter()
+        self._n_phase_probing(0)
+        if not self.dst_gaps:
+            raise PTRError("no valid trace in the first phase")
+        self.b_bw = get_bottleneck_bw(self.dst_gaps, self.packet_size)
+        interval = self.avg_dst_gap / 4
+        gap = self.avg_dst_gap / 2
+        double_check = False
+        first = True
+        saved_ptr, saved_abw = self.ptr_bw, self.a_bw
+        while self.phase_count < MAX_PHASE_NUM:
+            if not self._gap_comp():
+                if double_check:
+                    break
+                double_check = True
+            else:
+                double_check = False
+            if not first and self.tlt_dst_gap >= 1.5 * self.tlt_src_gap:
+                gap = max(gap, (self.tlt_src_gap + self.tlt_dst_gap) /
+                          (2 * self.total_count))
+            gap += interval
+            saved_ptr, saved_abw = self.ptr_bw, self.a_bw
+            self._n_phase_probing(gap)
+            first = False
+        return {
+            "ptr": saved_ptr,
+            "igi": saved_abw,
+            "bottleneck": self.b_bw,
+            "duration": time.perf_counter() - start,
+        }
+
+
+def get_bottleneck_bw(gaps, packet_size):
+    """
+    Estimates the bottleneck bandwidth from the most frequent dst gap
+    :param gaps: in-order gaps between arrivals at the server (seconds)
+    :param packet_size: size of the probing packets in bytes
+    :return: bottleneck bandwidth in bit/s
+    """
+    bins = {}
+    for gap in gaps:
+        value = int(gap / BIN_WIDTH)
+        bins[value] = bins.get(value, 0) + 1
+    # dicts keep insertion order, ties go to the first bin like in ptr-client
+    max_value = max(bins, key=bins.get)
+    lower_time = max_value * BIN_WIDTH
+    upper_time = (max_value + 1) * BIN_WIDTH
+    # see whether the adjacent two bins also have some items
+    if max_value + 1 in bins:
+        upper_time += BIN_WIDTH
+    if max_value - 1 in bins:
+        lower_time -= BIN_WIDTH
+    selected = [gap for gap in gaps if lower_time <= gap <= upper_time]
+    return packet_size * 8 / (sum(selected) / len(selected))
+
+
+def get_competing_bw(gaps, avg_src_gap, b_bw, packet_size):
+    """
+    Calculates the competing traffic rate using the IGI method
+    :param gaps: in-order gaps between arrivals at the server (seconds)
+    :param avg_src_gap: average gap between the probes when sent
+    :param b_bw: bottleneck bandwidth in bit/s
+    :param packet_size: size of the probing packets in bytes
+    :return: competing bandwidth in bit/s
+    """
+    b_gap = packet_size * 8 / b_bw
+    m_gap = max(b_gap, avg_src_gap)
+    gap_sum = sum(gaps)
+    inc_gap_sum = sum(gap - b_gap for gap in gaps if gap > m_gap + 0.000005)
+    if gap_sum == 0:
+        raise PTRError("no valid trace in the last phase")
+    return inc_gap_sum * b_bw / gap_sum
+
+
+class PTRFilter(asyncio.DatagramProtocol):
+    """
+    Records the arrival of the probes of one client and reports each train
+    over the client's control connection
+    """
+    def __init__(self, loop, control, probe_num):
+        self.loop = loop
+        self.control = control
+        self.probe_num = probe_num
+        self.records = []
+        self.phase_handle = None
+
+    def datagram_received(self, data, addr):
+        if not data:
+            # stray empty datagram, it carries no sequence number
+            return
+        now = time.perf_counter()
+        sec = int(now)
+        self.records.append(RECORD_FORMAT.pack(sec, int((now - sec) * 1000000), data[0]))
+        if self.phase_handle is not None:
+            self.phase_handle.cancel()
+        if len(self.records) >= self.probe_num:
+            self.phase_finish()
+        else:
+            self.phase_handle = self.loop.call_later(PHASE_WAIT, self.phase_finish)
+
+    def phase_finish(self):
+        self.phase_handle = None
+        data = b"".join(self.records)
+        self.records = []
+        self.control.send(("$%d$" % len(data)).encode() + data)
+
+
+class PTRControl(asyncio.Protocol):
+    """
+    Control connection of one probing client
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.filter_transport = None
+        self.filter = None
+        self.buf = b""
+        self.idle_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._reset_idle_timer()
+
+    def data_received(self, data):
+        self.buf += data
+        if self.filter_transport is not None or self.buf.count(b"$") < 3:
+            return
+        items = self.buf.split(b"$")
+        if items[1] != b"START":
+            self.transport.close()
+            return
+        probe_num = min(int(items[2]), MAX_PROBE_NUM)
+        self.buf = b""
+        self.loop.create_task(self._open_filter(probe_num))
+
+    async def _open_filter(self, probe_num):
+        self.filter_transport, self.filter = await self.loop.create_datagram_endpoint(
+            lambda: PTRFilter(self.loop, self, probe_num), local_addr=('0.0.0.0', 0))
+        port = self.filter_transport.get_extra_info('sockname')[1]
+        self.transport.write(("$READY$$%d$" % port).encode())
+
+    def send(self, data):
+        self._reset_idle_timer()
+        self.transport.write(data)
+
+    def connection_lost(self, exc):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        if self.filter is not None and self.filter.phase_handle is not None:
+            self.filter.phase_handle.cancel()
+        if self.filter_transport is not None:
+            self.filter_transport.close()
+
+    def _reset_idle_timer(self):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.idle_handle = self.loop.call_later(CLIENT_TIMEOUT, self.transport.close)
+
+
+def start_ptr_server(loop, port=PTR_SERVER_PORT):
+    """
+    Starts the ptr server on the given event loop
+    :param loop: asyncio event loop the clients are served on
+    :param port: TCP control port to listen on
+    :return: the asyncio server
+    """
+    coro = loop.create_server(lambda: PTRControl(loop), port=port,
+                              family=socket.AF_INET, reuse_address=True)
+    return loop.run_until_complete(coro)
+
+
+def ptr_server(port=PTR_SERVER_PORT):
+    """
+    Serves bandwidth probing clients, compatible with ptr-client and ptr_client()
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = start_ptr_server(loop, port)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+def main():
+    ptr_server()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`reload_plan.py` --- Selective reload of the SCION services of an AS
+==============================================================================
+"""
+# Stdlib
+import configparser
+import logging
+import os
+import subprocess
+
+# SCION-Box
+from topo_diff import diff_instances
+
+#: Topology entries whose instances run as supervisord programs
+SERVICE_TYPES = ["BorderRouters", "BeaconService", "CertificateService",
+                 "HiddenPathService", "PathService"]
+
+
+class ReloadPlan(object):
+    """
+    supervisord programs of one AS to add, stop and restart
+    """
+    def __init__(self, ia):
+        self.group = "as%s" % ia
+        self.added = []
+        self.stop = []
+        self.restart = []
+
+    def is_empty(self):
+        return not (self.added or self.stop or self.restart)
+
+    def program(self, name):
+        """
+        :returns: the supervisorctl name of a program in the group of this AS
+        """
+        return "%s:%s" % (self.group, name)
+
+
+def _internal_view(tp):
+    """
+    :returns: the part of a topology used by the border routers and sciond
+              of the AS, i.e. without the link addresses of the interfaces
+    """
+    view = dict((key, value) for key, value in tp.items() if key != "BorderRouters")
+    brs = {}
+    for name, br in tp.get("BorderRouters", {}).items():
+        interfaces = dict((str(if_id), (intf.get("ISD_AS"), intf.get("LinkType")))
+                          for if_id, intf in br.get("Interfaces", {}).items())
+        brs[name] = {'InternalAddrs': br.get("InternalAddrs"), 'Interfaces': interfaces}
+    view["BorderRouters"] = brs
+    return view
+
+
+def plan_reload(ia, old_tp, new_tp):
+    """
+    Compares two topologies of an AS and plans the reload of its services.
+    Only the border routers whose own entry changed are restarted, unless
+    one was added: the others have to learn its interface and only read
+    the topology at startup (SIGHUP would terminate them).
+    :param ia: ISD-AS of the topologies
+    :param dict old_tp: topology the running services were started with
+    :param dict new_tp: topology of the regenerated gen folder
+    :returns: ReloadPlan
+    """
+    plan = ReloadPlan(ia)
+    if old_tp == new_tp:
+        return plan
+    new_view = _internal_view(new_tp)
+    internal_changed = _internal_view(old_tp) != new_view
+    # the border routers can ignore the entries of removed border routers
+    kept_brs = dict((name, br) for name, br in old_tp.get("BorderRouters", {}).items()
+                    if name in new_tp.get("BorderRouters", {}))
+    brs_changed = _internal_view(dict(old_tp, BorderRouters=kept_brs)) != new_view
+    for svc_type in SERVICE_TYPES:
+        added, removed, changed, unchanged = diff_instances(old_tp.get(svc_type, {}),
+                                                            new_tp.get(svc_type, {}))
+        plan.added.extend(added)
+        plan.stop.extend(removed)
+        if svc_type != "BorderRouters":
+            # these services use the whole topology, which changed
+            plan.restart.extend(changed + unchanged)
+        elif brs_changed:
+            plan.restart.extend(changed + unchanged)
+        else:
+            plan.restart.extend(changed)
+    if internal_changed:
+        plan.restart.append("sd%s" % ia)
+    return plan
+
+
+def group_programs(conf_path):
+    """
+    :param str conf_path: supervisord.conf of an AS
+    :returns: the programs of the groups in the file, None if it has none
+    """
+    config = _read_config(conf_path)
+    if config is None:
+        return None
+    programs = None
+    for section in config.sections():
+        if section.startswith("group:"):
+            programs = (programs or []) + _split(config[section].get("programs", ""))
+    return programs
+
+
+def restrict_group(conf_path, programs):
+    """
+    Removes the programs that are not in programs from the groups of the
+    supervisord.conf of an AS. They then run as groups of their own and can
+    be added to a running supervisord without restarting the group.
+    :param str conf_path: supervisord.conf of an AS, written from scratch
+    :param list programs: programs of the running group, see group_programs()
+    """
+    config = _read_config(conf_path)
+    if config is None:
+        return
+    changed = False
+    for section in config.sections():
+        if not section.startswith("group:"):
+            continue
+        members = _split(config[section].get("programs", ""))
+        kept = [name for name in members if name in programs]
+        if kept != members:
+            config[section]["programs"] = ",".join(kept)
+            changed = True
+    if not changed:
+        return
+    tmp_path = "%s.tmp" % conf_path
+    with open(tmp_path, 'w') as conf_file:
+        config.write(conf_file)
+    os.replace(tmp_path, conf_path)
+
+
+def _read_config(conf_path):
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str
+    try:
+        with open(conf_path) as conf_file:
+            config.read_file(conf_file)
+    except (OSError, configparser.Error) as e:
+        logging.warning("Unable to read %s: %s", conf_path, e)
+        return None
+    return config
+
+
+def _split(programs):
+    return [name.strip() for name in programs.split(",") if name.strip()]
+
+
+def _running_names(supervisorctl, scion_path):
+    """
+    :returns: dictionary of program name to its supervisorctl name, i.e.
+              group:program, or only the program if it is a group of its own
+    """
+    try:
+        # status exits with an error code if a program is not running
+        proc = subprocess.run(supervisorctl + ["status"], cwd=scion_path,
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    except OSError as e:
+        logging.error("Failed to run supervisorctl: %s", e)
+        return {}
+    names = {}
+    for line in proc.stdout.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        name = fields[0].split(":", 1)[-1]
+        # a removed program can still be in its group, stopped
+        if name not in names or fields[1] == "RUNNING":
+            names[name] = fields[0]
+    return names
+
+
+def apply_reload(plan, scion_path):
+    """
+    Executes a reload plan with supervisorctl
+    :param ReloadPlan plan: the programs to add, stop and restart
+    :param str scion_path: directory of the SCION installation
+    :returns: True on success, False if SCION has to be restarted instead
+    """
+    supervisorctl = [os.path.expanduser("~/.local/bin/supervisorctl"), "-c",
+                     os.path.join(scion_path, "supervisor/supervisord.conf")]
+    names = _running_names(supervisorctl, scion_path)
+    stop = [names.get(name, plan.program(name)) for name in plan.stop]
+    commands = [["reread"]]
+    if stop:
+        commands.append(["stop"] + stop)
+    # programs added outside of the group are groups of their own, status
+    # lists them without a group
+    remove = [full_name for full_name in stop if ":" not in full_name]
+    if remove:
+        commands.append(["remove"] + remove)
+    if plan.added:
+        commands.append(["add"] + plan.added)
+    if plan.restart:
+        commands.append(["restart"] +
+                        [names.get(name, plan.program(name)) for name in plan.restart])
+    for command in commands:
+        logging.info("Reloading SCION: supervisorctl %s", " ".join(command))
+        try:
+            ret = subprocess.call(supervisorctl + command, cwd=scion_path)
+        except OSError as e:
+            logging.error("Failed to run supervisorctl: %s", e)
+            return False
+        if ret != 0:
+            logging.error("supervisorctl %s failed with exit code %s", command[0], ret)
+            return False
+    return True
@@ -16,15 +16,33 @@
 ==============================================================================
 """
 # Stdlib
+import asyncio
+import os
+import selectors
 import socket
-import datetime
+import struct
+import sys
+import time
+from array import array
 
 # SCION-Box
 from defines import(
     RTT_SERVER_PORT,
+    RTT_SERVER_BACKLOG,
+    RTT_SESSION_TIMEOUT,
+    RTT_PROBE_INTERVAL,
+    RTT_PROBE_TIMEOUT,
+    RTT_ECHO_ADDR,
     MEASUREMENTS,
+    INTERFACE,
 )
 
+#: Nanoseconds per millisecond, RTTs are reported in ms
+NS_PER_MS = 1000000
+#: UDP probe: magic, session id, sequence number, send timestamp in ns
+PROBE_FORMAT = struct.Struct("!4sIIQ")
+PROBE_MAGIC = b"SBRT"
+
 """
 The following configurations need to be customized to the Box
 """
@@ -35,29 +53,183 @@ def rtt_client(ip_address):
     :param: List of potential neighbor IP addresses
     :return: minimum of computed rtts
     """
-    # Find MAC and IP address
+    stats = rtt_measure(ip_address)
+    if stats is None:
+        return -1
+    return stats["min"]
+
+
+def _op_timeout(timeout, deadline):
+    """
+    Timeout of the next blocking socket operation
+    :param timeout: seconds one operation may take
+    :param deadline: time.monotonic() value by which the session has to
+                     finish, None for no deadline
+    :return: seconds, 0 if the deadline has passed
+    """
+    if deadline is None:
+        return timeout
+    return max(0, min(timeout, deadline - time.monotonic()))
+
+
+def rtt_measure(ip_address, port=RTT_SERVER_PORT, timeout=10, deadline=None):
+    """
+    Runs one measurement session against the rtt server. Probes are timed
+    with the monotonic high resolution clock, so wall-clock steps do not
+    distort the samples.
+    :param ip_address: IP address of the potential neighbor
+    :param port: TCP port of the rtt server
+    :param timeout: socket timeout in seconds for connecting and each probe
+    :param deadline: time.monotonic() value by which the whole session has to
+                     finish, the samples taken until then are returned
+    :return: dictionary of RTT statistics (see rtt_statistics) or None
+             if no connection could be established
+    """
+    samples = array('q')
+    sent = 0
+    if _op_timeout(timeout, deadline) == 0:
+        return None
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        m_list =[]
-        server_address = (ip_address, RTT_SERVER_PORT)
+        server_address = (ip_address, port)
         print ('connecting to %s port %s' % server_address)
-        sock.settimeout(10)
+        sock.settimeout(_op_timeout(timeout, deadline))
         sock.connect(server_address)
-        for i in range(0,MEASUREMENTS-1):
-            sendtime = datetime.datetime.now()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except socket.error as e:
+        print ("[ERROR]", e)
+        return None
+    try:
+        for i in range(0, MEASUREMENTS-1):
+            op_timeout = _op_timeout(timeout, deadline)
+            if op_timeout == 0:
+                break
+            sock.settimeout(op_timeout)
+            sent += 1
+            sendtime = time.perf_counter_ns()
             nonce = str(sendtime)
             sock.sendall(nonce.encode())
-            sock.recv(1024)
-            recvtime = datetime.datetime.now()
-            rtt = (recvtime - sendtime).microseconds / 1000
-            m_list.append(rtt)
-
+            if not sock.recv(1024):
+                break
+            samples.append(time.perf_counter_ns() - sendtime)
+    except socket.error as e:
+        print ("[ERROR]", e)
+    finally:
         sock.close()
+    if not samples:
+        return None
+    return rtt_statistics(samples, sent)
+
+
+def rtt_measure_udp(ip_address, port=RTT_SERVER_PORT, count=MEASUREMENTS,
+                    interval=RTT_PROBE_INTERVAL, timeout=RTT_PROBE_TIMEOUT, deadline=None):
+    """
+    Measures the RTT with pipelined UDP probes. The probes are sent every
+    interval seconds without waiting for the previous reply, replies are
+    matched to their probe by sequence number and may arrive out of order.
+    :param ip_address: IP address of the potential neighbor
+    :param port: UDP port of the rtt server
+    :param count: number of probes to send
+    :param interval: seconds between two probes
+    :param timeout: seconds to wait for replies after the last probe
+    :param deadline: time.monotonic() value by which the measurement has to
+                     finish, the replies received until then are used
+    :return: dictionary of RTT statistics (see rtt_statistics) or None
+             if no probe was answered
+    """
+    session = struct.unpack("!I", os.urandom(4))[0]
+    send_times = array('q', [0] * count)
+    rtts = array('q', [-1] * count)
+    received = 0
+    sent = 0
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sel = selectors.DefaultSelector()
+    server_address = (ip_address, port)
+    try:
+        # Not connected: the echo answers from the address it is bound to
+        # (INTERFACE or RTT_ECHO_ADDR), which can differ from ip_address,
+        # e.g. behind a NAT. The session id identifies the replies.
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+        next_send = time.perf_counter_ns()
+        # the deadline on the clock of the probes
+        end = None
+        if deadline is not None:
+            end = next_send + int((deadline - time.monotonic()) * 1e9)
+        replies_until = None
+        while received < count:
+            now = time.perf_counter_ns()
+            if end is not None and now >= end:
+                break
+            if sent < count and now >= next_send:
+                send_times[sent] = now
+                sock.sendto(PROBE_FORMAT.pack(PROBE_MAGIC, session, sent, now),
+                            server_address)
+                sent += 1
+                next_send += int(interval * 1e9)
+                if sent == count:
+                    replies_until = now + int(timeout * 1e9)
+                continue
+            wait_until = next_send if sent < count else replies_until
+            if end is not None:
+                wait_until = min(wait_until, end)
+            if now >= wait_until:
+                break
+            if not sel.select((wait_until - now) / 1e9):
+                continue
+            while True:
+                try:
+                    data = sock.recv(PROBE_FORMAT.size)
+                except BlockingIOError:
+                    break
+                recvtime = time.perf_counter_ns()
+                if len(data) != PROBE_FORMAT.size:
+                    continue
+                magic, reply_session, seq, stamp = PROBE_FORMAT.unpack(data)
+                # ignore stray, duplicated and forged replies
+                if (magic != PROBE_MAGIC or reply_session != session or seq >= sent or
+                        rtts[seq] != -1 or stamp != send_times[seq]):
+                    continue
+                rtts[seq] = recvtime - stamp
+                received += 1
     except socket.error as e:
         print ("[ERROR]", e)
-        return -1
+    finally:
+        sel.close()
+        sock.close()
+    if not received:
+        return None
+    samples = array('q', (rtt for rtt in rtts if rtt != -1))
+    return rtt_statistics(samples, sent)
+
 
-    return min(m_list)
+def rtt_statistics(samples, sent):
+    """
+    Summarizes the RTT samples of one neighbor
+    :param samples: array of RTT samples in nanoseconds
+    :param sent: number of probes sent, unanswered probes count as lost
+    :return: dictionary with min, median, p95 and jitter in ms and loss
+             as a fraction of the sent probes
+    """
+    ordered = sorted(samples)
+    n = len(ordered)
+    if n % 2:
+        median = ordered[n // 2]
+    else:
+        median = (ordered[n // 2 - 1] + ordered[n // 2]) / 2
+    # nearest-rank 95th percentile
+    p95 = ordered[max(0, -(-95 * n // 100) - 1)]
+    # mean difference between consecutive samples (RFC 3550 without smoothing)
+    jitter = 0
+    if n > 1:
+        jitter = sum(abs(samples[i] - samples[i-1]) for i in range(1, n)) / (n - 1)
+    return {
+        "min": ordered[0] / NS_PER_MS,
+        "median": median / NS_PER_MS,
+        "p95": p95 / NS_PER_MS,
+        "jitter": jitter / NS_PER_MS,
+        "loss": (sent - n) / sent if sent else 0.0,
+    }
 
 
 def rtt_server():
@@ -77,8 +249,138 @@ def rtt_server():
         clientsocket.close()
 
 
+class RTTServerStats(object):
+    """
+    Connection counters shared by all sessions of one concurrent RTT server
+    """
+    def __init__(self):
+        self.active = 0
+        self.total = 0
+        self.timed_out = 0
+        self.probes = 0
+
+
+class RTTSession(asyncio.Protocol):
+    """
+    One measurement session of the concurrent RTT server. Every chunk received
+    from the client is answered with an ACK, the session is closed when the
+    client hangs up or stays idle for longer than the session timeout.
+    """
+    def __init__(self, loop, stats, timeout):
+        self.loop = loop
+        self.stats = stats
+        self.timeout = timeout
+        self.transport = None
+        self.idle_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            # The ACK has to leave right away, do not let Nagle delay it
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stats.active += 1
+        self.stats.total += 1
+        address = transport.get_extra_info('peername')
+        print ('new connection from %s %s (%d active)' %
+               (address[0], address[1], self.stats.active))
+        self._reset_idle_timer()
+
+    def data_received(self, data):
+        self.transport.write("ACK".encode())
+        self._reset_idle_timer()
+
+    def connection_lost(self, exc):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.stats.active -= 1
+
+    def _reset_idle_timer(self):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.idle_handle = self.loop.call_later(self.timeout, self._idle_timeout)
+
+    def _idle_timeout(self):
+        self.stats.timed_out += 1
+        self.transport.close()
+
+
+class RTTProbeEcho(asyncio.DatagramProtocol):
+    """
+    Reflects UDP RTT probes unchanged to their sender. Anything that is not
+    a well-formed probe is dropped, so the echo cannot be used to reflect
+    arbitrary traffic to a spoofed source address.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) != PROBE_FORMAT.size or data[:4] != PROBE_MAGIC:
+            return
+        self.stats.probes += 1
+        self.transport.sendto(data, addr)
+
+
+def echo_address():
+    """
+    :return: the address the UDP probe echo is bound to, see RTT_ECHO_ADDR
+    """
+    if RTT_ECHO_ADDR:
+        return RTT_ECHO_ADDR
+    import netifaces as ni
+    return ni.ifaddresses(INTERFACE)[ni.AF_INET][0]['addr']
+
+
+def start_rtt_server(loop, port=RTT_SERVER_PORT, timeout=RTT_SESSION_TIMEOUT,
+                     echo_addr=None):
+    """
+    Starts the concurrent RTT server on the given event loop, TCP sessions
+    and UDP probes are served on the same port number
+    :param loop: asyncio event loop the sessions are served on
+    :param port: TCP and UDP port to listen on
+    :param timeout: seconds of inactivity after which a session is dropped
+    :param echo_addr: address of the UDP probe echo, see echo_address()
+    :return: the asyncio server, the UDP transport and their RTTServerStats
+    """
+    if echo_addr is None:
+        echo_addr = echo_address()
+    stats = RTTServerStats()
+    coro = loop.create_server(lambda: RTTSession(loop, stats, timeout),
+                              port=port, family=socket.AF_INET,
+                              backlog=RTT_SERVER_BACKLOG, reuse_address=True)
+    server = loop.run_until_complete(coro)
+    coro = loop.create_datagram_endpoint(lambda: RTTProbeEcho(stats),
+                                         local_addr=(echo_addr, port))
+    transport, _ = loop.run_until_complete(coro)
+    return server, transport, stats
+
+
+def rtt_server_async(port=RTT_SERVER_PORT, timeout=RTT_SESSION_TIMEOUT, echo_addr=None):
+    """
+    Sends back packets so the clients can compute the RTT. Unlike rtt_server()
+    all measurement sessions are served in parallel on a single event loop,
+    so concurrent clients do not queue up behind each other.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server, transport, stats = start_rtt_server(loop, port, timeout, echo_addr)
+    try:
+        loop.run_forever()
+    finally:
+        transport.close()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
 def main():
-    rtt_server()
+    # the address of the UDP echo can be given on the command line
+    echo_addr = sys.argv[1] if len(sys.argv) > 1 else None
+    rtt_server_async(echo_addr=echo_addr)
 
 if __name__ == '__main__':
     main()
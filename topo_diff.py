@@ -0,0 +1,112 @@
+# Copyright 2017 ETH Zurich
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+:mod:`topo_diff.py` --- Differences between two topologies
+==============================================================================
+"""
+
+
+def diff_instances(old_instances, new_instances):
+    """
+    Compares the service instances of one type of two topologies
+    :param dict old_instances: e.g. the BorderRouters entry of the old topology
+    :param dict new_instances: the same entry of the new topology
+    :returns: lists of the added, removed, changed and unchanged instance names
+    """
+    added = []
+    changed = []
+    unchanged = []
+    for name, instance in new_instances.items():
+        if name not in old_instances:
+            added.append(name)
+        elif old_instances[name] != instance:
+            changed.append(name)
+        else:
+            unchanged.append(name)
+    removed = [name for name in old_instances if name not in new_instances]
+    return added, removed, changed, unchanged
+
+
+#: Keys of a border router interface that hold its addresses
+INTERFACE_ADDRESS_KEYS = ('Public', 'Bind', 'Remote')
+
+
+class TopologyDiff(object):
+    """
+    Structural difference of two topologies of an AS
+    """
+    def __init__(self):
+        #: names of the added and removed border routers
+        self.added = []
+        self.removed = []
+        #: names of the border routers whose addresses changed
+        self.addr_changed = []
+        #: names of the border routers with other changes, e.g. the link type
+        self.changed = []
+        #: top level keys of the topology other than the border routers
+        self.other = []
+
+    def is_empty(self):
+        return not (self.added or self.removed or self.addr_changed or self.changed or
+                    self.other)
+
+    def __str__(self):
+        if self.is_empty():
+            return "no changes"
+        parts = []
+        for name, entries in (("added", self.added), ("removed", self.removed),
+                              ("address changed", self.addr_changed),
+                              ("changed", self.changed), ("other", self.other)):
+            if entries:
+                parts.append("%s: %s" % (name, ", ".join(entries)))
+        return "; ".join(parts)
+
+
+def diff_topology(old_tp, new_tp):
+    """
+    Compares two topologies of an AS, identical topologies give an empty
+    diff. A changed border router counts as address changed if its internal
+    addresses or the addresses of its interfaces differ, or if it got other
+    interfaces.
+    :param dict old_tp: the topology the AS is running with
+    :param dict new_tp: the updated topology
+    :returns: TopologyDiff
+    """
+    diff = TopologyDiff()
+    old_brs = old_tp.get('BorderRouters', {})
+    new_brs = new_tp.get('BorderRouters', {})
+    diff.added, diff.removed, changed, _ = diff_instances(old_brs, new_brs)
+    for name in changed:
+        if _br_addr_changed(old_brs[name], new_brs[name]):
+            diff.addr_changed.append(name)
+        else:
+            diff.changed.append(name)
+    for key in sorted(set(old_tp) | set(new_tp)):
+        if key != 'BorderRouters' and old_tp.get(key) != new_tp.get(key):
+            diff.other.append(key)
+    return diff
+
+
+def _br_addr_changed(old_br, new_br):
+    if old_br.get('InternalAddrs') != new_br.get('InternalAddrs'):
+        return True
+    old_ifs = old_br.get('Interfaces', {})
+    new_ifs = new_br.get('Interfaces', {})
+    if set(old_ifs) != set(new_ifs):
+        return True
+    for if_id, new_if in new_ifs.items():
+        old_if = old_ifs[if_id]
+        if any(old_if.get(key) != new_if.get(key) for key in INTERFACE_ADDRESS_KEYS):
+            return True
+    return False
@@ -18,12 +18,17 @@
 This file is located in $SCIONPATH/python/topology/
 """
 # Stdlib
+import argparse
 import copy
 import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
 import requests
 from shutil import rmtree
 from subprocess import call
+import threading
 import yaml
 
 
@@ -56,6 +61,27 @@ from local_config_util import (
     TYPES_TO_KEYS,
 )
 
+# SCION-Box
+import metrics
+from br_index import BRIndex
+from ccd_manager import CCDManager
+from coord_client import CoordinatorClient
+from gen_swap import (
+    GEN_STAGED,
+    abort_staging,
+    break_links,
+    clone_tree,
+    commit_staging,
+    gen_lock,
+    list_snapshots,
+    restore_snapshot,
+    staging_path,
+    take_snapshot,
+)
+from gen_writer import GEN_WORKERS, run_tasks, serialize_topology, write_topology
+from reload_plan import plan_reload, apply_reload, group_programs, restrict_group
+from topo_diff import diff_instances, diff_topology
+
 """
 The following configurations need to be customized to the AP
 """
@@ -65,6 +91,11 @@ ACC_ID = ""
 ACC_PW = ""
 #: Client configuration directory for openvpn
 OPENVPN_CCD = os.path.expanduser("~/openvpn_ccd")
+#: Directory of a gen folder holding the client configurations that go with it
+CCD_STATE_DIR = ".ccd"
+#: Directory of the node exporter textfile collector the phase timings are
+#: written to, nothing is written if it does not exist, empty disables them
+METRICS_DIR = metrics.DEFAULT_METRICS_DIR
 #: Different IP addresses
 # IP address used by remote border routers for connections (default: public IP address)
 INTF_ADDR = ""
@@ -79,6 +110,14 @@ MTU = 1472
 BANDWIDTH = 1000
 #: First internal port assigned to border routers
 BR_INTERNAL_START_PORT = 31050
+#: Number of local ASes requested and updated at the same time
+AS_WORKERS = 4
+#: Serializes the writers of the ASes where they touch the files of the
+#: SCION generator outside of the AS directories (dispatcher, sciond and
+#: prometheus configurations)
+_shared_files_lock = threading.Lock()
+#: Gzip the bodies of requests to the coordinator, it has to accept them
+COORD_COMPRESS = False
 
 #: Default key set for new SCIONLabAS join requests
 REMOVE = 'Remove'
@@ -92,6 +131,15 @@ CREATED = 'Created'
 GET_REQ = SCION_COORD_URL + "api/as/getUpdatesForAP"
 POST_REQ = SCION_COORD_URL + "api/as/confirmUpdatesFromAP"
 
+#: Client shared by all requests to the coordinator, see _coord_client()
+_client = None
+#: Index of the OpenVPN client configurations, see _ccd_manager()
+_ccd = None
+
+#: Result of applying the requested changes to the topology of one AS
+ASUpdate = namedtuple('ASUpdate', ['asid', 'as_obj', 'tp', 'new_tp', 'diff', 'acks',
+                                   'vpn_changes'])
+
 # Template for new_as_dict
 # new_as_dict = {
 #     '1-13': {
@@ -114,50 +162,139 @@ POST_REQ = SCION_COORD_URL + "api/as/confirmUpdatesFromAP"
 
 def update_local_gen():
     """
-    The main function that updates the topology configurations
-    """
-
-    is_modified = False
-    updated_ases = {}
-    original_topo = []
-    isdas_list = _get_my_asid()
-    new_as_dict, err = request_server(isdas_list)
-    if err:
-        print("[ERROR] Failed to connect to SCION-COORD server: \n%s" % err)
-        exit(1)
+    The main function that updates the topology configurations of all ASes
+    running on this machine. The ASes are updated concurrently in a staged
+    gen folder, which is only switched in once the SCION-coord received the
+    acknowledgment. An AS that fails to update keeps its configuration, an AS
+    whose topology ends up unchanged is neither written nor restarted.
+    """
+    # a concurrent run would stage its tree from the same old topologies
+    with gen_lock(os.path.join(PROJECT_ROOT, GEN_PATH)):
+        isdas_list = _get_my_asid()
+        with metrics.timer("coord_request", api="getUpdatesForAP"):
+            new_as_dict, err = request_server(isdas_list)
+        if err:
+            print("[ERROR] Failed to connect to SCION-COORD server: \n%s" % err)
+            exit(1)
 
-    for my_asid, new_reqs in new_as_dict.items():
-        if my_asid not in isdas_list:
-            continue
-        as_obj, tp = load_topology(my_asid)
-        original_topo.append((my_asid, as_obj, tp))
-        new_tp = copy.deepcopy(tp)
-        updated_ases[my_asid] = {}
-        updated_ases[my_asid][CREATED] = []
-        updated_ases[my_asid][UPDATED] = []
-        updated_ases[my_asid][REMOVED] = []
-        for req_type, ip_list in (
-            (REMOVE, updated_ases[my_asid][REMOVED]),
-            (UPDATE, updated_ases[my_asid][UPDATED]),
-            (CREATE, updated_ases[my_asid][CREATED]),
-        ):
-            if new_reqs[req_type]:
-                new_tp = update_topology(my_asid, new_reqs, req_type, ip_list, new_tp)
-                is_modified = True
-    if is_modified:
-        generate_local_gen(my_asid, as_obj, new_tp)
+        jobs = [(my_asid, new_reqs) for my_asid, new_reqs in new_as_dict.items()
+                if my_asid in isdas_list and
+                any(new_reqs[req_type] for req_type in (REMOVE, UPDATE, CREATE))]
+        if not jobs:
+            print("[INFO] Nothing changed. Not restarting SCION")
+            return
+        updates = []
+        with ThreadPoolExecutor(max_workers=min(AS_WORKERS, len(jobs))) as executor:
+            futures = [(my_asid, executor.submit(_update_as, my_asid, new_reqs))
+                       for my_asid, new_reqs in jobs]
+            for my_asid, future in futures:
+                try:
+                    updates.append(future.result())
+                except (Exception, SystemExit) as e:
+                    print("[ERROR] Failed to update %s, keeping its configuration: %s" %
+                          (my_asid, e))
+        changed = [update for update in updates if not update.diff.is_empty()]
+        gen_path = os.path.join(PROJECT_ROOT, GEN_PATH)
+        staged_path = None
+        if changed:
+            staged_path = staging_path(gen_path)
+            clone_tree(gen_path, staged_path)
+            # files outside of the AS directories are unshared once for all ASes
+            break_links(staged_path, recursive=False)
+            with metrics.timer("gen_generate"):
+                failed = _write_ases(gen_path, staged_path, changed)
+            updates = [update for update in updates if update.asid not in failed]
+            changed = [update for update in changed if update.asid not in failed]
+        if not updates:
+            if staged_path:
+                abort_staging(staged_path)
+            exit(1)
         print("[INFO] Configuration changed. Acknowlege to the SCION-COORD server")
-        _, err = request_server(isdas_list, ack_json=updated_ases)
+        updated_ases = {update.asid: update.acks for update in updates}
+        with metrics.timer("coord_request", api="confirmUpdatesFromAP"):
+            _, err = request_server(isdas_list, ack_json=updated_ases)
         if err:
             print("[ERROR] Failed to connect to SCION-COORD server: \n%s" % err)
-            for my_asid, as_obj, old_tp in original_topo:
-                print("[INFO] Retrieving the original topology congiguration: %s" % my_asid)
-                generate_local_gen(my_asid, as_obj, old_tp)
+            print("[INFO] Keeping the original topology configuration")
+            if staged_path:
+                abort_staging(staged_path)
             exit(1)
-        print("[INFO] Restarting SCION")
-        _restart_scion()
-    else:
-        print("[INFO] Nothing changed. Not restarting SCION")
+        vpn_changes = {}
+        for update in updates:
+            vpn_changes.update(update.vpn_changes)
+        if changed:
+            try:
+                _stage_ccd(staged_path, vpn_changes)
+            except BaseException:
+                abort_staging(staged_path)
+                raise
+            commit_staging(gen_path, staged_path)
+        elif staged_path:
+            abort_staging(staged_path)
+        _apply_vpn_changes(vpn_changes)
+        if not changed:
+            print("[INFO] Topologies unchanged. Not restarting SCION")
+        for update in changed:
+            print("[INFO] Topology of %s changed: %s" % (update.asid, update.diff))
+            print("[INFO] Reloading SCION: %s" % update.asid)
+            with metrics.timer("scion_reload"):
+                _reload_scion(update.asid, update.tp, update.new_tp)
+
+
+def _update_as(my_asid, new_reqs):
+    """
+    Applies the requested changes to the topology of one AS
+    :param str my_asid: ISD-AS string of the AS
+    :param dict new_reqs: the changes requested by the SCION-coord
+    :returns: ASUpdate
+    """
+    with metrics.timer("topology_load"):
+        as_obj, tp = load_topology(my_asid)
+    new_tp = copy.deepcopy(tp)
+    index = BRIndex(new_tp['BorderRouters'])
+    acks = {CREATED: [], UPDATED: [], REMOVED: []}
+    vpn_changes = {}
+    for req_type, ack_type in ((REMOVE, REMOVED), (UPDATE, UPDATED), (CREATE, CREATED)):
+        if new_reqs[req_type]:
+            new_tp = update_topology(my_asid, new_reqs, req_type, acks[ack_type], new_tp, index,
+                                     vpn_changes)
+    return ASUpdate(my_asid, as_obj, tp, new_tp, diff_topology(tp, new_tp), acks, vpn_changes)
+
+
+def _write_ases(gen_path, staged_path, updates):
+    """
+    Writes the gen folders of the changed ASes concurrently to the staged gen
+    folder, an AS that fails to write is reset to its live directory
+    :param str gen_path: the live gen folder
+    :param str staged_path: the staged gen folder
+    :param list updates: ASUpdates with changed topologies
+    :returns: set of the ISD-AS strings of the ASes that failed
+    """
+    failed = set()
+    with ThreadPoolExecutor(max_workers=min(AS_WORKERS, len(updates))) as executor:
+        futures = [(update, executor.submit(_write_local_gen, staged_path, TopoID(update.asid),
+                                            update.as_obj, update.new_tp, update.tp,
+                                            GEN_WORKERS, unshare_gen=False))
+                   for update in updates]
+        for update, future in futures:
+            try:
+                future.result()
+            except (Exception, SystemExit) as e:
+                print("[ERROR] Failed to update %s, keeping its configuration: %s" %
+                      (update.asid, e))
+                _restore_as(gen_path, staged_path, update.asid)
+                failed.add(update.asid)
+    return failed
+
+
+def _restore_as(gen_path, staged_path, my_asid):
+    """
+    Resets the directory of one AS in the staged gen folder to the live one
+    """
+    ia = TopoID(my_asid)
+    staged_as_path = get_elem_dir(staged_path, ia, "")
+    rmtree(staged_as_path, True)
+    clone_tree(get_elem_dir(gen_path, ia, ""), staged_as_path)
 
 
 def _get_my_asid():
@@ -181,6 +318,16 @@ def _get_my_asid():
     return isdas_list
 
 
+def _coord_client():
+    """
+    :returns: the CoordinatorClient, created on first use
+    """
+    global _client
+    if _client is None:
+        _client = CoordinatorClient(compress_requests=COORD_COMPRESS, pool_size=AS_WORKERS)
+    return _client
+
+
 def request_server(isdas_list, ack_json=None):
     """
     Communicate with SCION coordination server over HTTPS.
@@ -190,25 +337,30 @@ def request_server(isdas_list, ack_json=None):
     :param dict ack_json: updated SCIONLabAS's IP addresses
     :returns dict resp_dic:
     """
+    client = _coord_client()
     query = "scionLabAP="
     if ack_json:
         url = POST_REQ + "/" + ACC_ID + "/" + ACC_PW
         try:
-            resp = requests.post(url, json=ack_json)
-        except requests.exceptions.ConnectionError as e:
+            resp = client.post(url, ack_json)
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
             return None, e
         return None, None
     else:
-        url = GET_REQ + "/" + ACC_ID + "/" + ACC_PW + "?" + query
-        for my_asid in isdas_list:
-            url = url + my_asid
-            break  # AT this moment, we only support one AS for a machine
-        try:
-            resp = requests.get(url)
-        except requests.exceptions.ConnectionError as e:
-            return None, e
-        content = resp.content.decode('utf-8')
-        resp_dict = json.loads(content)
+        # the coordinator answers for one AS per request, ask for all at once
+        urls = [GET_REQ + "/" + ACC_ID + "/" + ACC_PW + "?" + query + my_asid
+                for my_asid in isdas_list]
+        resp_dict = {}
+        if not urls:
+            return resp_dict, None
+        with ThreadPoolExecutor(max_workers=min(AS_WORKERS, len(urls))) as executor:
+            try:
+                for resp in executor.map(client.get, urls):
+                    resp.raise_for_status()
+                    resp_dict.update(json.loads(resp.content.decode('utf-8')))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                return None, e
         print("[DEBUG] Recieved New SCIONLab ASes: \n%s" % resp_dict)
         return resp_dict, None
 
@@ -273,15 +425,23 @@ def _get_masterkey(conf_file):
     exit(1)
 
 
-def update_topology(my_asid, reqs, req_type, res_list, tp):
+def update_topology(my_asid, reqs, req_type, res_list, tp, index=None, vpn_changes=None):
     """
     Update the topology by adding, updating and removing BRs as requested.
     :param ISD_AS my_asid: current AS number
     :param dict requests: requested entities to be changed from current topology
     :param str req_type: type of requested changes
     :param list res_list: list that stores results of successfully update
+    :param BRIndex index: index of tp['BorderRouters'], kept up to date
+    :param dict vpn_changes: collects the changes of the VPN client
+                             configurations, applied right away if None
     :returns: the updated topology as dict
     """
+    if index is None:
+        index = BRIndex(tp['BorderRouters'])
+    apply_vpn_changes = vpn_changes is None
+    if apply_vpn_changes:
+        vpn_changes = {}
     for req in reqs[req_type]:
         user = req['UserEmail']
         as_id = req['ASID']
@@ -295,83 +455,105 @@ def update_topology(my_asid, reqs, req_type, res_list, tp):
         success = False
 
         if req_type == REMOVE:
-            current_br = _get_br_from_as(as_id, tp['BorderRouters'])
+            current_br = _get_br_from_as(as_id, index)
             if current_br and current_br == br_name:
                 tp = _remove_topology(br_name, tp)
+                index.remove(br_name)
                 if is_vpn:
-                    _remove_vpn_ip(user)
+                    vpn_changes[user] = None
                 success = True
         elif req_type == UPDATE:
-            current_br = _get_br_from_as(as_id, tp['BorderRouters'])
+            current_br = _get_br_from_as(as_id, index)
             if current_br is not None:
                 if current_br == br_name:
                     tp = _update_topology(br_name, if_id, as_id, as_ip, as_port, ap_port, is_vpn, tp)
                 else:
                     tp = _remove_topology(current_br, tp)
+                    index.remove(current_br)
                     tp = _create_topology(br_name, if_id, as_id, as_ip, as_port, ap_port, is_vpn, tp)
+                index.add(br_name, tp['BorderRouters'][br_name])
                 if is_vpn:
-                    _configure_vpn_ip(user, as_ip)
+                    vpn_changes[user] = _ccd_config(as_ip)
                 success = True
         else:
             tp = _create_topology(br_name, if_id, as_id, as_ip, as_port, ap_port, is_vpn, tp)
+            index.add(br_name, tp['BorderRouters'][br_name])
             if is_vpn:
-                _configure_vpn_ip(user, as_ip)
+                vpn_changes[user] = _ccd_config(as_ip)
             success = True
 
         if success:
             res_list.append(as_id)
+    if apply_vpn_changes:
+        _apply_vpn_changes(vpn_changes)
     return tp
 
 
-def _ccd_user(user):
+def _ccd_manager():
     """
-    Location where the vpn ip address is saved for given user
-    :param user: user email address
-    :return: location
+    :returns: the CCDManager of OPENVPN_CCD, created on first use
     """
-    return os.path.join(OPENVPN_CCD, user)
+    global _ccd
+    if _ccd is None:
+        _ccd = CCDManager(OPENVPN_CCD)
+    return _ccd
 
 
-def _configure_vpn_ip(user, vpn_ip):
+def _ccd_config(vpn_ip):
     """
-    Adds/updates the vpn ip address in the client-configuration directory
-    :param user: email of the user
-    :param vpn_ip: ip address to assign to this user
-    :return: void
+    Client configuration that assigns the vpn ip address to a user
+    :param vpn_ip: ip address to assign to the user
+    :return: content of the file in the client-configuration directory
     """
-    with open(_ccd_user(user), 'w') as vpn_config:
-        vpn_config.write("ifconfig-push " + vpn_ip + " " + VPN_NETMASK)
-    return
+    return "ifconfig-push " + vpn_ip + " " + VPN_NETMASK
 
 
-def _remove_vpn_ip(user):
+def _stage_ccd(staged_path, vpn_changes):
     """
-    Removes the vpn ip address in the client-configuration directory
-    :param user: email of the user
-    :return: void
+    Stores the client configurations that go with a staged gen folder in
+    it, so that rolling back to the gen folder restores them as well
+    :param str staged_path: the staged gen folder
+    :param dict vpn_changes: the changes that will be applied with it
     """
+    ccd_path = os.path.join(staged_path, CCD_STATE_DIR)
+    if not os.path.isdir(ccd_path):
+        # first run, the staged tree has no copy from the live one yet
+        clone_tree(OPENVPN_CCD, ccd_path)
+    # the copy is cloned with hard links, the manager replaces changed files
+    CCDManager(ccd_path).apply(vpn_changes)
+
+
+def _apply_vpn_changes(vpn_changes):
+    """
+    Writes the changed vpn ip addresses to the client-configuration directory
+    :param dict vpn_changes: user email to client configuration, None removes it
+    """
+    if not vpn_changes:
+        return
     try:
-      os.remove(_ccd_user(user))
-    except OSError:
-        pass
-    return
+        counts = _ccd_manager().apply(vpn_changes)
+    except OSError as e:
+        # the gen folder is switched in already, SCION still has to be reloaded
+        print("[ERROR] Failed to write the VPN client configurations: %s" % e)
+        return
+    for change, count in counts.items():
+        metrics.inc("vpn_client_configs", count, change=change)
+    print("[INFO] VPN client configurations: %(created)s created, %(updated)s updated, "
+          "%(removed)s removed, %(unchanged)s unchanged, %(invalid)s invalid" % counts)
 
 
-def _get_br_from_as(as_id, brs_dict):
+def _get_br_from_as(as_id, index):
     """
-    Parses border router topology and returns the ID of the current border router
-    corresponding to the given ISD-AS string
+    Returns the ID of the current border router corresponding to the given
+    ISD-AS string
     :param str as_id: ISD-AS string
-    :param dict brs_dict: dictionary of all border routers
+    :param BRIndex index: index of all border routers
     :returns: the border router name corresponding to this AS if it exists
     """
-    for br, br_dict in brs_dict.items():
-        for if_id, _ in br_dict['Interfaces'].items():
-            if br_dict['Interfaces'][if_id]['ISD_AS'] != as_id:
-                continue
-            else:
-                return br
-    return None
+    found = index.lookup(as_id)
+    if found is None:
+        return None
+    return found[0]
 
 
 def _remove_topology(br, tp):
@@ -481,34 +663,125 @@ def _intf_addr(is_vpn):
     return VPN_ADDR if is_vpn else INTF_ADDR
 
 
-def generate_local_gen(my_asid, as_obj, tp):
+def generate_local_gen(my_asid, as_obj, tp, old_tp=None, workers=GEN_WORKERS,
+                       staged=GEN_STAGED):
     """
     Creates the usual gen folder structure for an ISD/AS under gen
     :param str my_asid: ISD-AS as a string
     :param obj as_obj: An object that stores crypto information for AS
     :param dict tp: the topology parameter file as a dict of dicts
+    :param dict old_tp: the topology the existing gen folder was created from.
+                        If given, only the instances that were added or changed
+                        are written, the others only get the new topology file.
+    :param int workers: number of threads writing the instance directories
+    :param bool staged: write a copy of the gen folder and switch it in atomically
     """
     ia = TopoID(my_asid)
     gen_path = os.path.join(PROJECT_ROOT, GEN_PATH)
-    write_dispatcher_config(gen_path)
+    if tp == old_tp:
+        return
+    with gen_lock(gen_path):
+        if not staged:
+            take_snapshot(gen_path)
+            _write_local_gen(gen_path, ia, as_obj, tp, old_tp, workers)
+            return
+        staged_path = staging_path(gen_path)
+        try:
+            clone_tree(gen_path, staged_path)
+            _write_local_gen(staged_path, ia, as_obj, tp, old_tp, workers)
+        except BaseException:
+            abort_staging(staged_path)
+            raise
+        commit_staging(gen_path, staged_path)
+
+
+def _write_local_gen(gen_path, ia, as_obj, tp, old_tp, workers, unshare_gen=True):
+    """
+    Writes the gen folder of an ISD/AS, see generate_local_gen()
+    :param str gen_path: the gen folder or a staged copy of it
+    :param bool unshare_gen: unshare the files outside of the AS directory,
+                             False if the caller did that already
+    """
     as_path = get_elem_dir(gen_path, ia, "")
-    rmtree(as_path, True)
+    if old_tp is None:
+        # the staged tree shares the files of the live one
+        with _shared_files_lock:
+            if unshare_gen:
+                break_links(gen_path, recursive=False)
+            break_links(os.path.join(gen_path, "dispatcher"))
+            write_dispatcher_config(gen_path)
+        rmtree(as_path, True)
+    os.makedirs(as_path, exist_ok=True)
+    tasks = []
     for service_type, type_key in TYPES_TO_KEYS.items():
-        executable_name = TYPES_TO_EXECUTABLES[service_type]
-        instances = tp[type_key].keys()
-        for instance_name in instances:
-            config = prep_supervisord_conf(tp[type_key][instance_name], executable_name,
-                                           service_type, instance_name, ia)
-            instance_path = get_elem_dir(gen_path, ia, instance_name)
-            write_certs_trc_keys(ia, as_obj, instance_path)
-            write_as_conf_and_path_policy(ia, as_obj, instance_path)
-            write_supervisord_config(config, instance_path)
-            write_topology_file(tp, type_key, instance_path)
-            write_zlog_file(service_type, instance_name, instance_path)
+        if old_tp is None:
+            added, removed, changed, unchanged = list(tp[type_key]), [], [], []
+        else:
+            added, removed, changed, unchanged = diff_instances(old_tp.get(type_key, {}),
+                                                                tp[type_key])
+        for instance_name in removed:
+            rmtree(get_elem_dir(gen_path, ia, instance_name), True)
+        if tp == old_tp or not tp[type_key]:
+            continue
+        # every instance has a copy of the whole topology
+        topo_files = serialize_topology(write_topology_file, tp, type_key)
+        for instance_name in added + changed:
+            tasks.append(partial(_write_instance, ia, as_obj, tp, service_type, instance_name,
+                                 topo_files, gen_path))
+        for instance_name in unchanged:
+            tasks.append(partial(write_topology, topo_files,
+                                 get_elem_dir(gen_path, ia, instance_name)))
+    run_tasks(tasks, workers)
     # We don't need to create zk configration for existing ASes
     # generate_zk_config(tp, ia, GEN_PATH, simple_conf_mode=False)
-    generate_sciond_config(ia, as_obj, tp, gen_path)
-    generate_prom_config(ia, tp, gen_path)
+    if tp != old_tp:
+        conf_path = os.path.join(as_path, "supervisord.conf")
+        running = group_programs(conf_path) if old_tp is not None else None
+        break_links(as_path, recursive=False)
+        break_links(get_elem_dir(gen_path, ia, "endhost"))
+        # the generator may also write files outside of the AS directory
+        with _shared_files_lock:
+            if unshare_gen:
+                break_links(gen_path, recursive=False)
+            generate_sciond_config(ia, as_obj, tp, gen_path)
+            generate_prom_config(ia, tp, gen_path)
+        if running is not None:
+            # new programs are added to supervisord without the group
+            restrict_group(conf_path, running)
+
+
+def _write_instance(ia, as_obj, tp, service_type, instance_name, topo_files, gen_path):
+    """
+    Writes the directory of one service instance from scratch
+    :param dict topo_files: the serialized topology of the service type
+    """
+    type_key = TYPES_TO_KEYS[service_type]
+    config = prep_supervisord_conf(tp[type_key][instance_name],
+                                   TYPES_TO_EXECUTABLES[service_type],
+                                   service_type, instance_name, ia)
+    instance_path = get_elem_dir(gen_path, ia, instance_name)
+    rmtree(instance_path, True)
+    write_certs_trc_keys(ia, as_obj, instance_path)
+    write_as_conf_and_path_policy(ia, as_obj, instance_path)
+    write_supervisord_config(config, instance_path)
+    write_topology(topo_files, instance_path)
+    write_zlog_file(service_type, instance_name, instance_path)
+
+
+def _reload_scion(my_asid, old_tp, tp):
+    """
+    Stops, restarts or reloads only the services affected by a topology
+    change, restarts SCION if that fails
+    :param my_asid: ISD-AS of the changed topology
+    :param dict old_tp: topology the services are running with
+    :param dict tp: the new topology
+    """
+    plan = plan_reload(my_asid, old_tp, tp)
+    if plan.is_empty():
+        return
+    if not apply_reload(plan, PROJECT_ROOT):
+        print("[ERROR] Selective reload failed, restarting SCION")
+        _restart_scion()
 
 
 def _restart_scion():
@@ -521,13 +794,56 @@ def _restart_scion():
     call([scion_command, "run"])
 
 
+def rollback_local_gen():
+    """
+    Switches the gen folder and the client configurations back to the
+    newest snapshot and restarts SCION. The gen folder that was live becomes
+    the newest snapshot, a second rollback rolls forward again.
+    The SCION-coord is not told: it keeps the acknowledged state, and the
+    ASes that changed since are out of sync until the rollback is undone.
+    """
+    gen_path = os.path.join(PROJECT_ROOT, GEN_PATH)
+    with gen_lock(gen_path):
+        snapshots = list_snapshots(gen_path)
+        if not snapshots:
+            print("[ERROR] No snapshot of the gen folder to roll back to")
+            exit(1)
+        snapshot = snapshots[0]
+        ccd_path = os.path.join(snapshot, CCD_STATE_DIR)
+        if not os.path.isdir(ccd_path) and os.path.isdir(os.path.join(gen_path, CCD_STATE_DIR)):
+            # the client configurations may have changed since the snapshot
+            print("[ERROR] The snapshot %s has no VPN client configurations, "
+                  "not rolling back" % snapshot)
+            exit(1)
+        restore_snapshot(gen_path, snapshot)
+        if os.path.isdir(ccd_path):
+            counts = _ccd_manager().replace_all(CCDManager(ccd_path).configs())
+            print("[INFO] Rolled back the VPN client configurations: %(created)s created, "
+                  "%(updated)s updated, %(removed)s removed" % counts)
+        print("[INFO] Rolled back the gen folder to %s. Restarting SCION" % snapshot)
+        print("[WARNING] The SCION-COORD server is not told about the rollback, "
+              "run --rollback again to roll forward")
+        _restart_scion()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Updates the ASes of a SCIONLab AP")
+    parser.add_argument('--rollback', action='store_true',
+                        help="Restore the gen folder of before the last update")
+    args = parser.parse_args()
+    if args.rollback:
+        rollback_local_gen()
+        return
     if not os.path.exists(OPENVPN_CCD):
         os.makedirs(OPENVPN_CCD)
     if INTF_ADDR == "":
         print("Error: INTF_ADDR is not defined")
         return
-    update_local_gen()
+    try:
+        with metrics.timer("total"):
+            update_local_gen()
+    finally:
+        metrics.write_textfile(METRICS_DIR, "update_gen")
 
 
 if __name__ == '__main__':
@@ -18,7 +18,9 @@ Contains Definitions used throughout the scripts
 This file is located in $SCIONPATH/
 """
 # Stdlib
+import hashlib
 import os
+import posixpath
 import shutil
 import subprocess
 import tarfile
@@ -26,6 +28,7 @@ import json
 import netifaces as ni
 from shutil import rmtree
 import logging
+from functools import partial
 from itertools import groupby, count
 import yaml
 
@@ -49,6 +52,20 @@ from ad_manager.util.local_config_util import (
 )
 
 #SCION-BOX
+from gen_swap import (
+    GEN_STAGED,
+    abort_staging,
+    break_links,
+    clone_tree,
+    commit_staging,
+    gen_lock,
+    staging_path,
+    take_snapshot,
+)
+from gen_writer import GEN_WORKERS, run_tasks, serialize_topology, write_topology
+from port_scan import UDPReflector, adaptive_scan, open_port_ranges
+from reload_plan import plan_reload, apply_reload, group_programs, restrict_group
+from topo_diff import diff_instances
 from defines import(
     INITIAL_CERT_VERSION,
     INITIAL_TRC_VERSION,
@@ -65,6 +82,8 @@ from defines import(
     CONN_TESTER_PORTS,
     CONN_TESTER_START_PORT,
     CONN_TESTER_HOST,
+    UDP_REFLECTOR,
+    UDP_REFLECTOR_PORT,
     INTERFACE
 )
 
@@ -73,6 +92,18 @@ logging.basicConfig(filename=BOX_LOGFILE,level=logging.DEBUG, format=FORMAT)
 
 
 def test_connections():
+    """
+    Tests which UDP ports are reachable from the outside, in-process if a
+    UDP reflector is configured and with the connection-tester otherwise
+    :return: Dictionary of the Connection results
+    """
+    if UDP_REFLECTOR:
+        return adaptive_scan(UDPReflector(UDP_REFLECTOR, UDP_REFLECTOR_PORT),
+                             CONN_TESTER_START_PORT, CONN_TESTER_PORTS)
+    return _conn_tester_connections()
+
+
+def _conn_tester_connections():
     """
     Calls the connection-tester client with the specified json config
     :return: Dictionary of the Connection results
@@ -110,38 +141,15 @@ def test_connections():
 
 def connection_results_2_free_ports(results):
     """
-    Calculates the number of open UDP ports starting from 50000
+    Calculates the longest block of open UDP ports
     :param connection_list: list of connection results
-    :return: int: number of free Ports
+    :return: first port and number of free Ports of the block
     """
-    port_list = []
-    for result in results:
-        if result['result']:
-            port_list.append(result['port'])
-    if len(port_list) == 0:
+    ranges = open_port_ranges(results)
+    if not ranges:
         # No free Ports
         return 50000, 0
-    port_list.sort()
-    # Find the longest consecutive subsequence
-    port_list = port_list + [-1]  # add guard element
-    start_index = 0
-    seq_length = 0
-    # map of longest subsequence length starting at key index
-    index = 0
-    subsequences = [[]]
-    previous = port_list[0]
-    index += 1
-    while index < len(port_list):
-        if port_list[index] == previous + 1:
-            subsequences[-1].append(port_list[index])
-        else:
-            subsequences.append([port_list[index]])
-        previous = port_list[index]
-        index += 1
-    longest_sequence = max(subsequences, key=len)
-    start = longest_sequence[0]
-    seq_length = len(longest_sequence)
-    return start, seq_length
+    return ranges[0]
 
 
 def save_credentials(response):
@@ -153,71 +161,200 @@ def save_credentials(response):
         json.dump(response, outfile)
 
 
+#: Parsed credentials file and the (mtime, size) it was parsed at
+_credentials_cache = {}
+
+
 def get_credentials():
     """
-    Loads the Credentials file
+    Loads the Credentials file, the parsed content is reused as long as the
+    file is not modified
     :return Dictionary of the credentials
     """
-    with open('box_credentials.conf') as cred_file:
-        credentials = json.load(cred_file)
-    return credentials
+    st = os.stat('box_credentials.conf')
+    stamp = (st.st_mtime_ns, st.st_size)
+    if _credentials_cache.get('stamp') != stamp:
+        with open('box_credentials.conf') as cred_file:
+            _credentials_cache['credentials'] = json.load(cred_file)
+        _credentials_cache['stamp'] = stamp
+    return dict(_credentials_cache['credentials'])
 
 
 def parse_response(resp):
     """
-    Extracts the received file and copies the gen folder to the SCIONPATH
-    """
-    userMail = get_credentials()["UserMail"]
-    try:
-        shutil.rmtree(userMail)
-    except OSError:
-        pass
-    tar = resp.content
-    with open(userMail +".tar.gz", "wb") as file1:
-        file1.write(tar)
-    tar = tarfile.open(userMail +".tar.gz")
-    tar.extractall()
-    tar.close()
-    try:
-        shutil.rmtree(GEN_PATH)
-    except OSError as e:
-        logging.error("Error removing gen folder %s", e)
-    shutil.copytree(userMail + "/gen", GEN_PATH)
-    shutil.copy(userMail + "/box_credentials.conf", "box_credentials.conf")
+    Extracts the received tarball while it is downloaded. The gen folder is
+    written to a staged tree that replaces the old one atomically, the
+    credentials file is replaced as well.
+    :param resp: response requested with stream=True
+    """
+    with gen_lock(GEN_PATH):
+        staged_path = staging_path(GEN_PATH)
+        os.makedirs(staged_path)
+        credentials = None
+        gen_files = 0
+        try:
+            resp.raw.decode_content = True
+            with tarfile.open(fileobj=resp.raw, mode="r|gz") as tar:
+                for member in tar:
+                    # members are stored below a directory named after the user
+                    parts = _member_parts(member.name)
+                    if parts is None:
+                        logging.warning("Skipping tar member %s", member.name)
+                    elif parts[0] == "gen" and len(parts) > 1:
+                        _extract_member(tar, member, os.path.join(staged_path, *parts[1:]))
+                        gen_files += member.isfile()
+                    elif parts == ["box_credentials.conf"] and member.isfile():
+                        credentials = tar.extractfile(member).read()
+        except BaseException:
+            abort_staging(staged_path)
+            raise
+        finally:
+            resp.close()
+        if not gen_files:
+            # an empty tree would replace the running configuration
+            abort_staging(staged_path)
+            logging.error("The received tarball has no gen folder, keeping the old one")
+            exit(1)
+        commit_staging(GEN_PATH, staged_path)
+    if credentials is not None:
+        with open("box_credentials.conf.tmp", "wb") as cred_file:
+            cred_file.write(credentials)
+        os.replace("box_credentials.conf.tmp", "box_credentials.conf")
+
+
+def _member_parts(name):
+    """
+    :param str name: name of a tar member
+    :return: path components below the top directory, None if the member is
+             the top directory or points outside of it
+    """
+    if name.startswith("/"):
+        return None
+    # "./user/gen/..." and "user//gen/..." have the same top directory
+    parts = [part for part in posixpath.normpath(name).split("/") if part not in ("", ".")]
+    if ".." in parts:
+        return None
+    parts = parts[1:]
+    if not parts:
+        return None
+    return parts
+
+
+def _extract_member(tar, member, target):
+    """
+    Writes a directory or regular file of a streamed tarball to target
+    """
+    if member.isdir():
+        os.makedirs(target, exist_ok=True)
+    elif member.isfile():
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with tar.extractfile(member) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.chmod(target, member.mode & 0o777)
+    else:
+        logging.warning("Skipping tar member %s of type %s", member.name, member.type)
 
 
-def generate_local_gen(my_asid, as_obj, tp):
+def generate_local_gen(my_asid, as_obj, tp, old_tp=None, workers=GEN_WORKERS,
+                       staged=GEN_STAGED):
     """
     Creates the usual gen folder structure for an ISD/AS under gen
     :param str my_asid: ISD-AS as a string
     :param obj as_obj: An object that stores crypto information for AS
     :param dict tp: the topology parameter file as a dict of dicts
-    """
-    ia = my_asid
-    write_dispatcher_config(GEN_PATH)
-    as_path = get_elem_dir(GEN_PATH, ia, "")
-    rmtree(as_path, True)
+    :param dict old_tp: the topology the existing gen folder was created from.
+                        If given, only the instances that were added or changed
+                        are written, the others only get the new topology file.
+    :param int workers: number of threads writing the instance directories
+    :param bool staged: write a copy of the gen folder and switch it in atomically
+    """
+    if tp == old_tp:
+        return
+    with gen_lock(GEN_PATH):
+        if not staged:
+            take_snapshot(GEN_PATH)
+            _write_local_gen(GEN_PATH, my_asid, as_obj, tp, old_tp, workers)
+            return
+        staged_path = staging_path(GEN_PATH)
+        try:
+            clone_tree(GEN_PATH, staged_path)
+            _write_local_gen(staged_path, my_asid, as_obj, tp, old_tp, workers)
+        except BaseException:
+            abort_staging(staged_path)
+            raise
+        commit_staging(GEN_PATH, staged_path)
+
+
+def _write_local_gen(gen_path, ia, as_obj, tp, old_tp, workers):
+    """
+    Writes the gen folder of an ISD/AS, see generate_local_gen()
+    :param str gen_path: the gen folder or a staged copy of it
+    """
+    as_path = get_elem_dir(gen_path, ia, "")
+    if old_tp is None:
+        # the staged tree shares the files of the live one
+        break_links(gen_path, recursive=False)
+        break_links(os.path.join(gen_path, "dispatcher"))
+        write_dispatcher_config(gen_path)
+        rmtree(as_path, True)
+    os.makedirs(as_path, exist_ok=True)
+    tasks = []
     for service_type, type_key in TYPES_TO_KEYS.items():
-        executable_name = TYPES_TO_EXECUTABLES[service_type]
-        instances = tp[type_key].keys()
-        for instance_name in instances:
-            config = prep_supervisord_conf(tp[type_key][instance_name], executable_name,
-                                           service_type, instance_name, ia)
-            instance_path = get_elem_dir(GEN_PATH, ia, instance_name)
-            write_certs_trc_keys(ia, as_obj, instance_path)
-            write_as_conf_and_path_policy(ia, as_obj, instance_path)
-            write_supervisord_config(config, instance_path)
-            write_topology_file(tp, type_key, instance_path)
-            write_zlog_file(service_type, instance_name, instance_path)
-    write_endhost_config(tp, ia, as_obj, GEN_PATH)
-    generate_sciond_config(tp, ia, GEN_PATH, as_obj)
+        if old_tp is None:
+            added, removed, changed, unchanged = list(tp[type_key]), [], [], []
+        else:
+            added, removed, changed, unchanged = diff_instances(old_tp.get(type_key, {}),
+                                                                tp[type_key])
+        for instance_name in removed:
+            rmtree(get_elem_dir(gen_path, ia, instance_name), True)
+        if tp == old_tp or not tp[type_key]:
+            continue
+        # every instance has a copy of the whole topology
+        topo_files = serialize_topology(write_topology_file, tp, type_key)
+        for instance_name in added + changed:
+            tasks.append(partial(_write_instance, ia, as_obj, tp, service_type, instance_name,
+                                 topo_files, gen_path))
+        for instance_name in unchanged:
+            tasks.append(partial(write_topology, topo_files,
+                                 get_elem_dir(gen_path, ia, instance_name)))
+    run_tasks(tasks, workers)
+    if tp != old_tp:
+        break_links(get_elem_dir(gen_path, ia, "endhost"))
+        write_endhost_config(tp, ia, as_obj, gen_path)
+    if old_tp is None or _sciond_group_programs(old_tp, ia) != _sciond_group_programs(tp, ia):
+        conf_path = os.path.join(as_path, "supervisord.conf")
+        running = group_programs(conf_path) if old_tp is not None else None
+        break_links(as_path, recursive=False)
+        generate_sciond_config(tp, ia, gen_path, as_obj)
+        if running is not None:
+            # new programs are added to supervisord without the group
+            restrict_group(conf_path, running)
     # We don't need to create zk configration for existing ASes
     # generate_zk_config(tp, ia, GEN_PATH, simple_conf_mode=False)
 
-def generate_sciond_config(tp, ia, local_gen_path, as_obj):
-    executable_name = "sciond"
-    instance_name = "sd%s" % str(ia)
-    service_type = "sciond"
+
+def _write_instance(ia, as_obj, tp, service_type, instance_name, topo_files, gen_path):
+    """
+    Writes the directory of one service instance from scratch
+    :param dict topo_files: the serialized topology of the service type
+    """
+    type_key = TYPES_TO_KEYS[service_type]
+    config = prep_supervisord_conf(tp[type_key][instance_name],
+                                   TYPES_TO_EXECUTABLES[service_type],
+                                   service_type, instance_name, ia)
+    instance_path = get_elem_dir(gen_path, ia, instance_name)
+    rmtree(instance_path, True)
+    write_certs_trc_keys(ia, as_obj, instance_path)
+    write_as_conf_and_path_policy(ia, as_obj, instance_path)
+    write_supervisord_config(config, instance_path)
+    write_topology(topo_files, instance_path)
+    write_zlog_file(service_type, instance_name, instance_path)
+
+
+def _sciond_group_programs(tp, ia):
+    """
+    :returns: the programs of the supervisord group of the AS
+    """
     processes = []
     for svc_type in ["BorderRouters", "BeaconService", "CertificateService",
                      "HiddenPathService", "PathService"]:
@@ -225,7 +362,15 @@ def generate_sciond_config(tp, ia, local_gen_path, as_obj):
             continue
         for elem_id, elem in tp[svc_type].items():
             processes.append(elem_id)
-    processes.append(instance_name)
+    processes.append("sd%s" % str(ia))
+    return processes
+
+
+def generate_sciond_config(tp, ia, local_gen_path, as_obj):
+    executable_name = "sciond"
+    instance_name = "sd%s" % str(ia)
+    service_type = "sciond"
+    processes = _sciond_group_programs(tp, ia)
     config = prep_supervisord_conf(None, executable_name, service_type, instance_name, ia)
     config['group:'  "as%s" % str(ia)] = {'programs': ",".join(processes)}
     sciond_conf_path = get_elem_dir(local_gen_path, ia, "")
@@ -247,6 +392,12 @@ def _get_my_asid():
     return isdas_list
 
 
+#: Process path found for each AS directory
+_process_path_cache = {}
+#: Credentials and raw topology file for each process path, with the file stamps
+_topology_cache = {}
+
+
 def _get_process_path(path):
     """
     Searching one of the existing process directories from the topology directory
@@ -254,8 +405,12 @@ def _get_process_path(path):
     :param str gen_path: path for sub directory of target as (e.g., 'gen/ISD1/AS11')
     :returns: a process path (e.g., 'gen/ISD1/AS11/br1-11-1')
     """
+    cached = _process_path_cache.get(path)
+    if cached is not None and os.path.isfile(os.path.join(cached, 'topology.json')):
+        return cached
     for root, dirs, files in os.walk(path):
         if 'topology.json' in files:
+            _process_path_cache[path] = root
             return root
     logging.error("Cannot find topology file")
     exit(1)
@@ -282,9 +437,25 @@ def _get_current_br(br_dict):
     return None
 
 
+def _file_stamps(paths):
+    """
+    :param paths: list of file paths
+    :returns: tuple of (inode, mtime, size) of the files, None if one is missing
+    """
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamps.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(stamps)
+
+
 def load_topology(ia):
     """
-    Reload the current topology configuration.
+    Reload the current topology configuration. The parsed files are cached
+    and only read again when one of them changed on disk.
     :returns: as topology as json
     """
     isd_number = str(ia._isd)
@@ -292,65 +463,86 @@ def load_topology(ia):
     isd_directory = "ISD" + isd_number
     as_directory = "AS" + as_number
     process_path = _get_process_path(GEN_PATH + "/" + isd_directory + "/" + as_directory)
+    paths = [process_path + "/" + 'topology.json',
+             process_path + "/" + 'keys/as-sig.key',
+             process_path + "/" + 'keys/as-decrypt.key',
+             process_path + "/" + 'certs/ISD%s-AS%s-V%s.crt' %
+             (isd_number, as_number, INITIAL_CERT_VERSION),
+             process_path + "/" + 'certs/ISD%s-V%s.trc' % (isd_number, INITIAL_TRC_VERSION),
+             process_path + "/" + 'as.yml']
+    stamps = _file_stamps(paths)
+    cached = _topology_cache.get(process_path)
+    if stamps is not None and cached is not None and cached[0] == stamps:
+        # callers modify the topology in place, parsing the cached file
+        # gives each of them its own dict faster than a deepcopy would
+        return cached[1], json.loads(cached[2])
+    topo_path, sig_path, enc_path, cert_path, trc_path, conf_path = paths
     try:
-        with open(process_path + "/" + 'topology.json') as topo_file:
-            topo_dict = json.load(topo_file)
-        with open(process_path + "/" + 'keys/as-sig.key') as sig_file:
+        with open(topo_path, 'rb') as topo_file:
+            topo_data = topo_file.read()
+        with open(sig_path) as sig_file:
             sig_priv_key = sig_file.read()
-        with open(process_path + "/" +  'keys/as-decrypt.key') as enc_file:
+        with open(enc_path) as enc_file:
             enc_priv_key = enc_file.read()
-        with open(process_path + "/" + 'certs/ISD%s-AS%s-V%s.crt' %
-                               (isd_number, str(ia._as), INITIAL_CERT_VERSION)) as cert_file:
+        with open(cert_path) as cert_file:
             certificate = cert_file.read()
-        with open(process_path + "/" + 'certs/ISD%s-V%s.trc' %
-                               (isd_number, INITIAL_TRC_VERSION)) as trc_file:
+        with open(trc_path) as trc_file:
             trc = trc_file.read()
-        with open(process_path + "/" + 'as.yml') as conf_file:
+        with open(conf_path) as conf_file:
             master_as_key = _get_masterkey(conf_file)
     except OSError as e:
         logging.error("to open '%s': \n%s" % (e.filename, e.strerror))
         exit(1)
     as_obj = ASCredential(sig_priv_key, enc_priv_key, certificate, trc, master_as_key)
-    return as_obj, topo_dict
+    if stamps is not None:
+        _topology_cache[process_path] = (stamps, as_obj, topo_data)
+    return as_obj, json.loads(topo_data)
 
 
-def _remove_br(new_neighbor, topo):
+def _remove_br(new_neighbor, topo, index=None):
     """
     Removes a border router.
     :param new_neighbor: dictionary of removed neighbor
     :param topo: current topology
+    :param index: BRIndex of the topology, kept up to date if given
     :return: updated topology
     """
-    br, br_id = _get_br_id(new_neighbor, topo)
+    br, br_id = _get_br_id(new_neighbor, topo, index)
     del topo['BorderRouters'][br]
+    if index is not None:
+        index.remove(br)
     return topo
 
 
-def _update_br(new_neighbor, topo):
+def _update_br(new_neighbor, topo, index=None):
     """
     Updates a border router.
     :param new_neighbor: dictionary of the modified neighbor
     :param topo: current topology
+    :param index: BRIndex of the topology, kept up to date if given
     :return: updated topology
     """
-    br, br_id = _get_br_id(new_neighbor, topo)
+    br, br_id = _get_br_id(new_neighbor, topo, index)
     if br_id != 0:
         topo['BorderRouters'][br]['Interfaces'][br_id]['Remote']['Addr'] = new_neighbor['NeighborIP']
         topo['BorderRouters'][br]['Interfaces'][br_id]['Remote']['L4Port'] = new_neighbor['RemotePort']
     else:
-        return _add_br(new_neighbor, topo)
+        return _add_br(new_neighbor, topo, index)
     return topo
 
 
-def _get_br_id(neighbor, topo):
+def _get_br_id(neighbor, topo, index=None):
     """
     Returns the br-id of the br connected to the ia
     :param neighbors: dictionary of a neighbor
     :param topo: current topology
+    :param index: BRIndex of the topology, avoids scanning all border routers
     :return: br-id string, id of the br int
     """
     brs = topo["BorderRouters"]
     neighbor_ia = "%s-%s" % (str(neighbor["NeighborISD"]), str(neighbor["NeighborAS"]))
+    if index is not None:
+        return index.lookup(neighbor_ia) or ("", 0)
     for br in brs:
         for item in brs[br]["Interfaces"]:
             if brs[br]["Interfaces"][item]["ISD_AS"] == neighbor_ia:
@@ -358,11 +550,12 @@ def _get_br_id(neighbor, topo):
     return "", 0
 
 
-def _add_br(new_neighbor, topo):
+def _add_br(new_neighbor, topo, index=None):
     """
     Adds a new border router to the topology
     :param new_neighbor: dictionary of new neighbor
     :param topo: current topology
+    :param index: BRIndex of the topology, kept up to date if given
     :return: updated topology
     """
     br_id, br_port, if_id, external_port, neighbor_addr, ext_addr, linktype, internal_port, int_addr, ia = _get_new_br_obj(
@@ -401,6 +594,8 @@ def _add_br(new_neighbor, topo):
             }
         }
     }
+    if index is not None:
+        index.add(br_id, topo['BorderRouters'][br_id])
     return topo
 
 
@@ -471,6 +666,17 @@ def assemble_current_br_list(ia):
     return br_list
 
 
+def topology_fingerprint(br_list):
+    """
+    Computes a fingerprint of a list of border routers, independent of the
+    order of the list
+    :param br_list: list of border routers as built by assemble_current_br_list
+    :return: hex encoded SHA-256 of the canonical list
+    """
+    canonical = "\n".join(sorted(json.dumps(br, sort_keys=True) for br in br_list))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
 def start_scion():
     """
     Starts scion using ./scion.sh run
@@ -495,3 +701,19 @@ def restart_scion():
 
     p = subprocess.Popen([scion_command, "run"], cwd=SCION_PATH)
     p.wait()
+
+
+def reload_scion(ia, old_tp, tp):
+    """
+    Stops, restarts or reloads only the services of the AS affected by a
+    topology change, restarts SCION if that fails
+    :param ia: ISD-AS of the changed topology
+    :param dict old_tp: topology the services are running with
+    :param dict tp: the new topology
+    """
+    plan = plan_reload(ia, old_tp, tp)
+    if plan.is_empty():
+        return
+    if not apply_reload(plan, SCION_PATH):
+        logging.error("Selective reload failed, restarting SCION")
+        restart_scion()